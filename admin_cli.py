@@ -0,0 +1,287 @@
+"""
+مهام إدارية مجمعة بدون واجهة Streamlit
+======================================
+نفس محرك login.py (get_storage / get_df / calc_fees / BOOK_FEES_MAP) من سطر الأوامر:
+
+    python admin_cli.py rollover --dry-run
+    python admin_cli.py rollover --chunk 500
+    python admin_cli.py rollover --academic-year 2026-2027
+    python admin_cli.py recompute --out balances.csv --by Year Major
+    python admin_cli.py export --table Students_Main --out roster.csv
+
+الكتابة على دفعات (batch_update لكل دفعة) بأولوية bulk في منظم الحصة،
+والترحيل بيحفظ الخطة ومكان آخر دفعة في checkpoint عشان لو وقف يكمل من نفس المكان،
+وبعد ما يخلص الـ checkpoint بيفضل كسجل إن السنة الدراسية اترحلت (التكرار محتاج --force).
+الترحيل بيقفل مستحقات السنة اللي خلصت بقيد charge في الدفتر (عمود Carried_* في التقارير)،
+فالمتأخرات (أو الزيادة) بتترحل مع الطالب للسنة الجديدة بدل ما المدفوع القديم يتحسب من مصاريفها.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+
+import pandas as pd
+
+import login
+
+
+# ---------------------------------------------------------
+# 1. أدوات مشتركة
+# ---------------------------------------------------------
+
+def progress(label, done, total, t0):
+    """سطر تقدم واحد على stderr (العدد والنسبة والوقت المتبقي)"""
+    elapsed = time.monotonic() - t0
+    eta = elapsed / done * (total - done) if done else 0
+    pct = done * 100 // total if total else 100
+    print(f"\r[{label}] {done:,}/{total:,} ({pct}%) ETA {eta:.0f}s", end="", file=sys.stderr, flush=True)
+    if done >= total: print(file=sys.stderr)
+
+
+class Checkpoint:
+    """ملف JSON فيه خطة المهمة وعدد العناصر اللي اتكتبت (الحفظ atomic)"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, state):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+    def clear(self):
+        try: os.remove(self.path)
+        except OSError: pass
+
+
+def with_retry(fn, attempts):
+    """إعادة المحاولة عند 429 بانتظار متزايد؛ أي خطأ تاني يوقف المهمة (والـ checkpoint محفوظ)"""
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if not login._is_quota_error(e) or attempt == attempts - 1: raise
+            time.sleep(min(2 ** attempt, login.WRITE_MAX_BACKOFF))
+
+def write_csv(df, path, chunk, label):
+    """كتابة CSV على أجزاء مع تقدم (utf-8-sig عشان إكسل يقرأ العربي)"""
+    t0 = time.monotonic()
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        for start in range(0, len(df), chunk):
+            df.iloc[start:start + chunk].to_csv(f, header=start == 0, index=False)
+            progress(label, min(start + chunk, len(df)), len(df), t0)
+    if df.empty: df.to_csv(path, index=False, encoding="utf-8-sig")
+
+def load_students():
+    df = login.get_df("Students_Main")
+    if df.empty: raise SystemExit("جدول الطلاب فارغ أو تعذر الاتصال")
+    return df
+
+# ---------------------------------------------------------
+# 2. المهام
+# ---------------------------------------------------------
+
+def plan_rollover(df, max_year):
+    """
+    خطة الترحيل: [(الكود، الفرقة الجديدة)] لكل طالب فرقته من 1 لحد max_year - 1.
+    الفرقة الأخيرة بتفضل زي ما هي، والفرقة غير الصالحة بتتعد وتتساب.
+    """
+    year = pd.to_numeric(df["Year"].astype(str), errors="coerce")
+    move = year.between(1, max_year - 1)
+    plan = [[str(c), int(y) + 1] for c, y in zip(df.loc[move, "Code"], year[move])]
+    stats = {
+        "promoted": dict(sorted(Counter(f"{y - 1}->{y}" for _, y in plan).items())),
+        "final_year": int((year >= max_year).sum()),
+        "invalid_year": int(year.isna().sum()),
+    }
+    return plan, stats
+
+def default_academic_year(now=None):
+    """السنة الدراسية اللي بتبدأ (الترحيل بيتعمل في الصيف): 2026-2027 من يونيو 2026 لحد مايو 2027"""
+    now = now or datetime.now()
+    y = now.year if now.month >= 6 else now.year - 1
+    return f"{y}-{y + 1}"
+
+def closing_rows(tag, items, now):
+    """
+    قيود إقفال السنة اللي خلصت (charge) لكل طالب في الدفعة: مستحقات السنة القديمة
+    بتتضاف على المطلوب منه (Carried_*)، فالباقي عليه أو الزيادة بتترحل للسنة الجديدة.
+    Ref ثابت لكل (سنة دراسية، كود، بند) عشان الاستكمال أو إعادة التشغيل مايكررش القيد.
+    """
+    rows = []
+    for code, new_year in items:
+        old = new_year - 1
+        dues = {"المصاريف": login.calc_fees(old), "الكتب": login.BOOK_FEES_MAP.get(old, 2000)}
+        for item, due in dues.items():
+            rows.append([code, "charge", item, f"{due} EGP", now, f"إقفال مستحقات الفرقة {old}",
+                         f"rollover-{tag}-{code}-{login.PAY_ITEMS[item]}"])
+    return rows
+
+def check_resume(state, df, max_age_h, academic_year):
+    """الـ checkpoint لازم يكون حديث ومطابق للبيانات الحالية (كل طالب في الخطة لسه قبل الترحيل أو بعده مباشرة)"""
+    if state.get("academic_year") != academic_year:
+        return f"الـ checkpoint لسنة {state.get('academic_year')} مش {academic_year}"
+    age_h = (time.time() - state.get("created_ts", 0)) / 3600
+    if age_h > max_age_h:
+        return f"الـ checkpoint عمره {age_h:.0f} ساعة (الحد {max_age_h})"
+    year = dict(zip(df["Code"].astype(str).str.strip(), pd.to_numeric(df["Year"].astype(str), errors="coerce")))
+    bad = [c for c, y in state["items"] if year.get(c) not in (y - 1, y)]
+    if bad:
+        return f"{len(bad):,} طالب في الخطة فرقتهم الحالية مش مطابقة (مثلاً {bad[0]})"
+    return None
+
+def cmd_rollover(args):
+    """ترحيل كل الطلاب للفرقة التالية مع إقفال مستحقات السنة، على دفعات وcheckpoint بعد كل دفعة"""
+    ckpt = Checkpoint(args.checkpoint)
+    ay = args.academic_year
+    state = ckpt.load()
+    if state and state.get("job") != "rollover": state = None
+    if state and state.get("finished"):
+        # سجل ترحيل خلص: مابيتستكملش، ونفس السنة الدراسية مابتترحلش مرتين إلا بطلب صريح
+        if state.get("academic_year") == ay and not args.force:
+            raise SystemExit(f"ترحيل {ay} اتعمل بالفعل ({state['finished']}، {len(state['items']):,} طالب). "
+                             f"لو مقصود ترحيل تاني شغل بـ --force")
+        state = None
+    elif state and args.discard_checkpoint:
+        if not args.dry_run: ckpt.clear()
+        state = None
+    storage = login.get_storage()
+    df = load_students()
+    if state:
+        problem = check_resume(state, df, args.max_checkpoint_age, ay)
+        if problem:
+            raise SystemExit(f"{problem}: مش هيتم الاستكمال. راجع {args.checkpoint} أو شغل بـ --discard-checkpoint")
+        print(f"استكمال ترحيل بدأ {state['created']}: {state['done']:,}/{len(state['items']):,}")
+    else:
+        plan, stats = plan_rollover(df, args.max_year)
+        print(json.dumps(stats, ensure_ascii=False))
+        plan_id = uuid.uuid4().hex[:8]
+        # الـ Ref بالسنة الدراسية: قيود إقفال موجودة للخطة = الطلاب دول اترحلوا السنة دي (حتى لو الـ checkpoint اتمسح)
+        tag = f"{ay}-{plan_id}" if args.force else ay
+        if not args.force:
+            rows = closing_rows(tag, plan, "")
+            seen = with_retry(lambda: storage.existing_refs([r[-1] for r in rows]), args.retries)
+            if seen:
+                done = {r[0] for r in rows if r[-1] in seen}
+                raise SystemExit(f"{len(done):,} طالب اترحلوا بالفعل في {ay} (مثلاً {min(done)}). "
+                                 f"لو مقصود ترحيل تاني شغل بـ --force")
+        state = {"job": "rollover", "id": plan_id, "academic_year": ay, "tag": tag,
+                 "created": str(datetime.now()), "created_ts": time.time(),
+                 "max_year": args.max_year, "items": plan, "done": 0}
+        if not args.dry_run: ckpt.save(state)
+    items = state["items"]
+    if args.dry_run:
+        left = items[state["done"]:]
+        charged = sum(int(r[3].split()[0]) for r in closing_rows(state["tag"], left, ""))
+        print(f"[dry-run] {len(left):,} طالب هيترحل في {-(-len(left) // args.chunk)} دفعة، "
+              f"وإقفال مستحقات بإجمالي {charged:,}")
+        return 0
+
+    t0 = time.monotonic()
+    resumed = state["done"] > 0
+    with login.api_priority("bulk"):
+        for start in range(state["done"], len(items), args.chunk):
+            part = items[start:start + args.chunk]
+            rows = closing_rows(state["tag"], part, str(datetime.now()))
+            if resumed:
+                # أول دفعة بعد توقف ممكن قيودها تكون اتكتبت قبل ما الـ checkpoint يتحفظ
+                seen = with_retry(lambda: storage.existing_refs([r[-1] for r in rows]), args.retries)
+                rows = [r for r in rows if r[-1] not in seen]
+                resumed = False
+            updates = [(c, "Year", y) for c, y in part]
+            with login.schema_guard():
+                if rows: with_retry(lambda: storage.append_rows("Ledger", rows), args.retries)
+                with_retry(lambda: storage.batch_update("Students_Main", updates), args.retries)
+            state["done"] = start + len(part)
+            ckpt.save(state)
+            progress("rollover", state["done"], len(items), t0)
+    login.invalidate_df("Students_Main", "Ledger")
+    state["finished"] = str(datetime.now())
+    ckpt.save(state)
+    print(f"تم ترحيل {len(items):,} طالب في {time.monotonic() - t0:.1f}s")
+    return 0
+
+def cmd_recompute(args):
+    """إعادة حساب المستحق والمدفوع والمتبقي لكل الطلاب (finance_report) وتصديره"""
+    t0 = time.monotonic()
+    rep = login.finance_report(load_students(), login.ledger_money(login.get_df("Ledger")))
+    print(f"تم الحساب لـ {len(rep):,} طالب في {time.monotonic() - t0:.2f}s")
+    summary = login.finance_summary(rep, args.by)
+    print(summary.to_string(index=False))
+    if args.dry_run:
+        print(f"[dry-run] مفيش ملفات اتكتبت ({args.out})")
+        return 0
+    write_csv(rep, args.out, args.chunk, "recompute")
+    print(f"التفاصيل في {args.out}")
+    return 0
+
+def cmd_export(args):
+    """تصدير جدول كامل لملف CSV (بدون كلمات المرور إلا بطلب صريح)"""
+    df = login.get_df(args.table)
+    if not args.with_passwords:
+        df = df.drop(columns=["Password"], errors="ignore")
+    if args.dry_run:
+        print(f"[dry-run] {len(df):,} صف × {len(df.columns)} عمود -> {args.out}")
+        return 0
+    write_csv(df, args.out, args.chunk, "export")
+    print(f"تم تصدير {len(df):,} صف إلى {args.out}")
+    return 0
+
+# ---------------------------------------------------------
+# 3. سطر الأوامر
+# ---------------------------------------------------------
+
+def main(argv=None):
+    # الخيارات المشتركة على كل أمر فرعي (admin_cli.py rollover --dry-run)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--dry-run", action="store_true", help="plan and report only, write nothing")
+    common.add_argument("--chunk", type=int, default=500, help="rows per batched write")
+
+    p = argparse.ArgumentParser(description="Batch administrative jobs for the institute system (no Streamlit UI)")
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    r = sub.add_parser("rollover", parents=[common],
+                       help="promote every student to the next Year and close the finished year's dues")
+    r.add_argument("--max-year", type=int, default=max(login.BOOK_FEES_MAP), help="final year (not promoted)")
+    r.add_argument("--checkpoint", default=os.path.join(login.DATA_DIR, "rollover.checkpoint.json"))
+    r.add_argument("--max-checkpoint-age", type=float, default=24.0, help="hours before a checkpoint is refused")
+    r.add_argument("--academic-year", default=default_academic_year(), help="academic year being started, e.g. 2026-2027")
+    r.add_argument("--discard-checkpoint", action="store_true", help="ignore an unfinished checkpoint and plan afresh")
+    r.add_argument("--force", action="store_true", help="roll over again even if this academic year was already done")
+    r.add_argument("--retries", type=int, default=login.WRITE_MAX_ATTEMPTS, help="attempts per chunk on 429")
+    r.set_defaults(func=cmd_rollover)
+
+    c = sub.add_parser("recompute", parents=[common], help="recompute due / paid / outstanding for every student")
+    c.add_argument("--out", default="finance_balances.csv")
+    c.add_argument("--by", nargs="+", default=["Year"], choices=["Year", "Major", "Governorate"])
+    c.set_defaults(func=cmd_recompute)
+
+    e = sub.add_parser("export", parents=[common], help="export a table to CSV")
+    e.add_argument("--table", default="Students_Main", choices=list(login.SCHEMA_MAP))
+    e.add_argument("--out", default="roster.csv")
+    e.add_argument("--with-passwords", action="store_true")
+    e.set_defaults(func=cmd_export)
+
+    args = p.parse_args(argv)
+    if args.chunk < 1: p.error("--chunk must be >= 1")
+    if login.get_storage() is None: raise SystemExit("تعذر الاتصال بمحرك التخزين")
+    # إصلاح الهيكل بيكتب (شيتات / عناوين / ALTER)، فمش بيشتغل في dry-run
+    if not args.dry_run: login.ensure_schema()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,497 @@
+"""
+قياس أداء المحرك بدون Google الحقيقي
+=====================================
+سيرفر Sheets وهمي داخل نفس العملية (نفس أسطح gspread اللي login.py بيستخدمها)
+بزمن استجابة قابل للضبط وحصة 60 طلب/دقيقة ترجع 429، وسيناريوهات جاهزة:
+
+    python bench_sheets.py --rows 100000 --latency-ms 120
+    python bench_sheets.py --scenario login_storm --ops 500 --json
+
+كل سيناريو بيطبع p50/p99 للزمن وعدد طلبات الـ API لكل عملية،
+وسيناريو session_memory بيطبع ذاكرة الجلسة الواحدة وحجم الجدول المشترك.
+"""
+import argparse
+import json
+import random
+import re
+import shutil
+import string
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+import gspread
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+import login
+
+
+# ---------------------------------------------------------
+# 1. السيرفر الوهمي (Fake Sheets)
+# ---------------------------------------------------------
+
+class _FakeResponse:
+    """رد HTTP بالشكل اللي gspread.exceptions.APIError بيقراه"""
+
+    def __init__(self, code, message):
+        self.status_code = code
+        self.text = message
+        self._body = {"error": {"code": code, "message": message, "status": "RESOURCE_EXHAUSTED"}}
+
+    def json(self):
+        return self._body
+
+
+class FakeServer:
+    """الزمن والحصة وعداد الطلبات المشترك بين كل الشيتات"""
+
+    def __init__(self, latency_ms=0.0, quota=60, window=60.0):
+        self.latency = latency_ms / 1000.0
+        self.quota = quota
+        self.window = window
+        self.calls = 0
+        self.throttled = 0
+        self._recent = deque()
+        self._lock = threading.Lock()
+
+    def hit(self):
+        with self._lock:
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] > self.window:
+                self._recent.popleft()
+            self.calls += 1
+            if self.quota and len(self._recent) >= self.quota:
+                self.throttled += 1
+                raise gspread.exceptions.APIError(_FakeResponse(429, "Quota exceeded (fake)"))
+            self._recent.append(now)
+        if self.latency: time.sleep(self.latency)
+
+
+class FakeCell:
+    def __init__(self, row, col, value=""):
+        self.row = row
+        self.col = col
+        self.value = value
+
+
+_A1 = re.compile(r"^([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?$")
+
+def _col_num(letters):
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n
+
+def _parse_a1(a1):
+    """(صف أول، عمود أول، صف أخير، عمود أخير) - None = لحد آخر الجدول"""
+    m = _A1.match(a1)
+    if not m: raise ValueError(f"bad range {a1}")
+    c1, r1, c2, r2 = m.groups()
+    if m.group(3) is None and m.group(4) is None:
+        c2, r2 = c1, r1
+    return (int(r1) if r1 else 1, _col_num(c1) if c1 else 1,
+            int(r2) if r2 else None, _col_num(c2) if c2 else None)
+
+
+class FakeWorksheet:
+    def __init__(self, server, title, rows=None):
+        self.server = server
+        self.title = title
+        self.id = id(self)
+        self._rows = rows if rows is not None else []
+        self._lock = threading.Lock()
+
+    # --- أدوات داخلية ---
+    def _cell(self, r, c):
+        if r <= len(self._rows) and c <= len(self._rows[r - 1]):
+            return self._rows[r - 1][c - 1]
+        return ""
+
+    def _set(self, r, c, value):
+        while len(self._rows) < r:
+            self._rows.append([])
+        row = self._rows[r - 1]
+        while len(row) < c:
+            row.append("")
+        row[c - 1] = "" if value is None else str(value)
+
+    def _get(self, a1):
+        r1, c1, r2, c2 = _parse_a1(a1)
+        r2 = r2 or len(self._rows)
+        c2 = c2 or max((len(r) for r in self._rows), default=0)
+        out = []
+        for r in range(r1, r2 + 1):
+            vals = [self._cell(r, c) for c in range(c1, c2 + 1)]
+            while vals and vals[-1] == "":
+                vals.pop()
+            out.append(vals)
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    # --- سطح gspread ---
+    def get_all_records(self, **kwargs):
+        self.server.hit()
+        with self._lock:
+            if not self._rows: return []
+            header = self._rows[0]
+            return [
+                dict(zip(header, gspread.utils.numericise_all((r + [""] * len(header))[:len(header)], default_blank="")))
+                for r in self._rows[1:]
+            ]
+
+    def col_values(self, col):
+        self.server.hit()
+        with self._lock:
+            vals = [self._cell(r, col) for r in range(1, len(self._rows) + 1)]
+        while vals and vals[-1] == "":
+            vals.pop()
+        return vals
+
+    def row_values(self, row):
+        self.server.hit()
+        with self._lock:
+            vals = list(self._rows[row - 1]) if row <= len(self._rows) else []
+        while vals and vals[-1] == "":
+            vals.pop()
+        return vals
+
+    def cell(self, row, col):
+        self.server.hit()
+        with self._lock:
+            return FakeCell(row, col, self._cell(row, col))
+
+    def find(self, query):
+        self.server.hit()
+        with self._lock:
+            for r, row in enumerate(self._rows, 1):
+                for c, v in enumerate(row, 1):
+                    if v == str(query): return FakeCell(r, c, v)
+        return None
+
+    def range(self, r1, c1, r2, c2):
+        self.server.hit()
+        with self._lock:
+            return [FakeCell(r, c, self._cell(r, c)) for r in range(r1, r2 + 1) for c in range(c1, c2 + 1)]
+
+    def update_cells(self, cells):
+        self.server.hit()
+        with self._lock:
+            for cell in cells:
+                self._set(cell.row, cell.col, cell.value)
+
+    def update_cell(self, row, col, value):
+        self.server.hit()
+        with self._lock:
+            self._set(row, col, value)
+
+    def append_row(self, row, **kwargs):
+        self.append_rows([row])
+
+    def append_rows(self, rows, **kwargs):
+        self.server.hit()
+        with self._lock:
+            self._rows.extend([["" if v is None else str(v) for v in row] for row in rows])
+
+    def batch_get(self, ranges, **kwargs):
+        self.server.hit()
+        with self._lock:
+            return [self._get(a1) for a1 in ranges]
+
+    def batch_update(self, data, **kwargs):
+        self.server.hit()
+        with self._lock:
+            for item in data:
+                r1, c1, _, _ = _parse_a1(item["range"])
+                for dr, vals in enumerate(item["values"]):
+                    for dc, v in enumerate(vals):
+                        self._set(r1 + dr, c1 + dc, v)
+
+    def update(self, values=None, range_name="A1", **kwargs):
+        self.server.hit()
+        with self._lock:
+            r1, c1, _, _ = _parse_a1(range_name)
+            for dr, vals in enumerate(values or []):
+                for dc, v in enumerate(vals):
+                    self._set(r1 + dr, c1 + dc, v)
+
+    def clear(self):
+        self.server.hit()
+        with self._lock:
+            self._rows = []
+
+    def resize(self, rows=None, cols=None):
+        self.server.hit()
+
+
+class FakeSpreadsheet:
+    def __init__(self, server):
+        self.server = server
+        self.title = login.SHEET_NAME
+        self._tabs = {}
+
+    def worksheet(self, title):
+        self.server.hit()
+        if title not in self._tabs:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self._tabs[title]
+
+    def worksheets(self):
+        self.server.hit()
+        return list(self._tabs.values())
+
+    def add_worksheet(self, title, rows, cols, **kwargs):
+        self.server.hit()
+        self._tabs[title] = FakeWorksheet(self.server, title)
+        return self._tabs[title]
+
+    def del_worksheet(self, ws):
+        self.server.hit()
+        self._tabs.pop(ws.title, None)
+
+    def batch_update(self, body):
+        self.server.hit()
+        gone = {r["deleteSheet"]["sheetId"] for r in body.get("requests", []) if "deleteSheet" in r}
+        self._tabs = {t: ws for t, ws in self._tabs.items() if ws.id not in gone}
+        return {"replies": [{} for _ in body.get("requests", [])]}
+
+    def values_batch_get(self, ranges, params=None):
+        self.server.hit()
+        out = []
+        for rng in ranges:
+            title, _, a1 = rng.partition("!")
+            ws = self._tabs[title.strip("'")]
+            with ws._lock:
+                out.append({"range": rng, "values": ws._get(a1 or "A1:")})
+        return {"valueRanges": out}
+
+
+class FakeClient:
+    def __init__(self, server):
+        self.server = server
+        self.spreadsheet = FakeSpreadsheet(server)
+
+    def open(self, name):
+        self.server.hit()
+        if name != login.SHEET_NAME:
+            raise gspread.exceptions.SpreadsheetNotFound(name)
+        return self.spreadsheet
+
+
+# ---------------------------------------------------------
+# 2. تجهيز البيانات
+# ---------------------------------------------------------
+
+MAJORS = ["نظم معلومات إدارية", "محاسبة", "إدارة أعمال"]
+GOVS = ["القاهرة", "الجيزة", "الإسكندرية", "الدقهلية", "أسيوط"]
+
+def make_roster(n, seed=7):
+    """n طالب بكل أعمدة HEADERS_STUDENT (أكواد وكلمات مرور معروفة للسيناريوهات)"""
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n):
+        row = {h: "" for h in login.HEADERS_STUDENT}
+        row.update({
+            "Code": f"{string.ascii_uppercase[i % 26]}{i:07d}",
+            "Name": f"طالب رقم {i}",
+            "Password": f"pw{i:06d}",
+            "Year": str(rnd.randint(1, 4)),
+            "Paid_Tuition": str(rnd.choice([0, 5000, 18000])),
+            "Paid_Books": str(rnd.choice([0, 2000])),
+            "National_ID": f"{29900000000000 + i}",
+            "Phone": f"010{i:08d}",
+            "Governorate": rnd.choice(GOVS),
+            "Major": rnd.choice(MAJORS),
+            "Seat_Num": str(100000 + i),
+            "Join_Date": "2025-09-01 10:00:00",
+        })
+        rows.append([row[h] for h in login.HEADERS_STUDENT])
+    return rows
+
+def build_fake(rows, latency_ms, quota, window, ledger_per_student=3):
+    server = FakeServer(latency_ms, quota, window)
+    client = FakeClient(server)
+    sheet = client.spreadsheet
+    roster = make_roster(rows)
+    tabs = {
+        "Students_Main": [login.HEADERS_STUDENT] + roster,
+        "Teachers_Main": [login.HEADERS_TEACHER],
+        "Subjects_Data": [login.HEADERS_SUBJECTS],
+        "Ledger": [login.HEADERS_LEDGER] + [
+            [r[0], "grade", f"نتيجة مادة {k}", "ناجح", "2025-12-01", "", ""]
+            for r in roster for k in range(ledger_per_student)
+        ],
+    }
+    for title, data in tabs.items():
+        sheet._tabs[title] = FakeWorksheet(server, title, [list(r) for r in data])
+    return client, roster
+
+
+def install(client, data_dir):
+    """
+    توجيه login.py للسيرفر الوهمي ومسح كل الكاش المشترك. الـ client بيتغلف بنفس
+    instrument() بتاع الإنتاج، فالقياس بيعدي على منظم الحصة والمراقبة زي الحقيقة.
+    """
+    server = client.server
+    login.STORAGE_BACKEND = "sheets"
+    login.DATA_DIR = data_dir
+    login.API_QUOTA_PER_MIN = server.quota * 60.0 / server.window if server.quota else 1e9
+    st.cache_resource.clear()
+    login.get_client = lambda: login.instrument(client)
+    # الفحص الأولي خارج القياس (زي أول تشغيل للعملية)
+    login.get_schema_state().version = login.SCHEMA_VERSION
+
+
+# ---------------------------------------------------------
+# 3. السيناريوهات
+# ---------------------------------------------------------
+
+def _timed(server, fn):
+    c0 = server.calls
+    t0 = time.perf_counter()
+    err = None
+    try:
+        fn()
+    except Exception as e:
+        err = e
+    return (time.perf_counter() - t0) * 1000, server.calls - c0, err
+
+def login_storm(client, roster, ops):
+    """دخول طلاب متتالي (أول دخول بيبني الفهرس والباقي من الذاكرة)"""
+    picks = random.Random(1).choices(roster, k=ops)
+    return [_timed(client.server, lambda r=r: login.check_login("Student", r[0], r[2])) for r in picks]
+
+def bulk_registration(client, roster, ops, batch=500):
+    """تسجيل دفعات من ملف (bulk_register_students)، كل عملية = دفعة"""
+    out = []
+    for b in range(ops):
+        df = pd.DataFrame({
+            "Name": [f"مستجد {b}-{i}" for i in range(batch)],
+            "National_ID": [f"{30100000000000 + b * batch + i}" for i in range(batch)],
+            "Major": MAJORS[0], "Governorate": GOVS[0],
+        })
+        out.append(_timed(client.server, lambda df=df: login.bulk_register_students(df)))
+    return out
+
+def treasury_payment_burst(client, roster, ops, drain_timeout=120):
+    """دفعات خزينة متتالية (قيود دفع في الدفتر): زمن الزرار (الطابور) ثم زمن رفع الكل"""
+    q = login.get_write_queue()
+    picks = random.Random(2).choices(roster, k=ops)
+    out = [
+        _timed(client.server, lambda r=r: q.submit(
+            "payment", ws="Ledger", row=[r[0], "payment", "المصاريف", "100 EGP", "2026-01-01", ""]))
+        for r in picks
+    ]
+    c0, t0 = client.server.calls, time.perf_counter()
+    q.flush_now()
+    while q.status()["pending"] and time.perf_counter() - t0 < drain_timeout:
+        time.sleep(0.05)
+    drain = {"drain_ms": round((time.perf_counter() - t0) * 1000, 1),
+             "drain_calls": client.server.calls - c0, "left_pending": q.status()["pending"]}
+    return out, drain
+
+def student_portal_view(client, roster, ops):
+    """فتح بوابة الطالب: السجل من الدفتر الموحد"""
+    picks = random.Random(3).choices(roster, k=ops)
+    return [_timed(client.server, lambda r=r: login.get_ledger(r[0])) for r in picks]
+
+def _traced(make, keys):
+    """الذاكرة اللي اتحجزت (bytes) لبناء حالة جلسة لكل مفتاح"""
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    sessions = [make(k) for k in keys]
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return used, sessions
+
+def session_memory(client, roster, ops):
+    """
+    ops جلسة مفتوحة: الطريقة القديمة (صف كامل لكل جلسة) مقابل الجديدة (الكود بس
+    والسجل من الفهرس المشترك)، وحجم جدول الطلاب قبل وبعد compact_roster.
+    """
+    raw = login._records_df([login.HEADERS_STUDENT] + roster)
+    shared = login.get_df("Students_Main")
+    idx = login._fresh_index("Student", roster[0][0])
+    picks = random.Random(4).choices(range(len(roster)), k=ops)
+
+    legacy, _ = _traced(lambda i: {"role": "Student", "user": raw.iloc[i].to_dict(),
+                                   "fin_user": raw.iloc[i].to_dict()}, picks)
+    compact, sessions = _traced(lambda i: {"role": "Student", "user_code": idx.record(roster[i][0])["Code"],
+                                           "fin_code": roster[i][0]}, picks)
+    out = [_timed(client.server, lambda s=s: idx.record(s["user_code"])) for s in sessions]
+    mb = lambda df: round(df.memory_usage(deep=True).sum() / 2**20, 2)
+    return out, {
+        "legacy_bytes_per_session": legacy // max(ops, 1),
+        "compact_bytes_per_session": compact // max(ops, 1),
+        "roster_mb_object": mb(raw),
+        "roster_mb_compact": mb(shared),
+    }
+
+SCENARIOS = {
+    "login_storm": login_storm,
+    "bulk_registration": bulk_registration,
+    "treasury_payment_burst": treasury_payment_burst,
+    "student_portal_view": student_portal_view,
+    "session_memory": session_memory,
+}
+
+DEFAULT_OPS = {"login_storm": 500, "bulk_registration": 2, "treasury_payment_burst": 15, "student_portal_view": 200,
+               "session_memory": 500}
+
+
+def summarize(name, samples, extra=None):
+    lat = np.array([s[0] for s in samples]) if samples else np.zeros(1)
+    calls = [s[1] for s in samples]
+    res = {
+        "scenario": name,
+        "ops": len(samples),
+        "p50_ms": round(float(np.percentile(lat, 50)), 2),
+        "p99_ms": round(float(np.percentile(lat, 99)), 2),
+        "api_calls_per_op": round(sum(calls) / max(len(samples), 1), 3),
+        "errors": sum(1 for s in samples if s[2] is not None),
+    }
+    res.update(extra or {})
+    return res
+
+def run(args):
+    results = []
+    for name in args.scenario or list(SCENARIOS):
+        client, roster = build_fake(args.rows, args.latency_ms, args.quota, args.window)
+        data_dir = tempfile.mkdtemp(prefix="bench_login_")
+        try:
+            install(client, data_dir)
+            ops = args.ops or DEFAULT_OPS[name]
+            out = SCENARIOS[name](client, roster, ops)
+            extra = None
+            if isinstance(out, tuple): out, extra = out
+            res = summarize(name, out, extra)
+            res["throttled_429"] = client.server.throttled
+            res["scheduler_wait_s"] = round(sum(login.get_api_scheduler().status()["waited_s"].values()), 2)
+            results.append(res)
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    return results
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark login.py against an in-process fake Google Sheets")
+    p.add_argument("--rows", type=int, default=10000, help="roster size (up to 100k)")
+    p.add_argument("--latency-ms", type=float, default=50.0, help="simulated latency per API call")
+    p.add_argument("--quota", type=int, default=60, help="requests per window before 429 (0 = unlimited)")
+    p.add_argument("--window", type=float, default=60.0, help="quota window in seconds")
+    p.add_argument("--ops", type=int, default=0, help="operations per scenario (0 = scenario default)")
+    p.add_argument("--scenario", action="append", choices=list(SCENARIOS))
+    p.add_argument("--json", action="store_true", help="print JSON lines instead of a table")
+    args = p.parse_args()
+
+    results = run(args)
+    if args.json:
+        for r in results: print(json.dumps(r, ensure_ascii=False))
+    else:
+        print(pd.DataFrame(results).set_index("scenario").to_string())
+
+if __name__ == "__main__":
+    main()
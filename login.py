@@ -1,24 +1,40 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import random
 import string
 from datetime import datetime
 import time
+import os
+import sqlite3
+import threading
+import hashlib
+import json
+import uuid
+import re
+import contextvars
+import heapq
+import bisect
+import itertools
+import logging
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # اللقطات اختيارية
+    pa = feather = None
+
+logger = logging.getLogger(__name__)
 
 # ---------------------------------------------------------
 # 1. إعدادات النظام والتصميم الذهبي (Golden UI)
 # ---------------------------------------------------------
-st.set_page_config(
-    page_title="المعاهد العليا | Golden System",
-    layout="wide",
-    page_icon="🎓",
-    initial_sidebar_state="expanded"
-)
-
 # تخصيص CSS للغة العربية والتصميم الاحترافي
-st.markdown("""
+PAGE_CSS = """
 <style>
     @import url('https://fonts.googleapis.com/css2?family=Tajawal:wght@400;700&display=swap');
     
@@ -45,10 +61,47 @@ st.markdown("""
         color: #2c3e50;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+def setup_page():
+    """إعداد الصفحة والتصميم - جوه main() عشان الملف يتعمله import من السكريبتات (benchmark / CLI)"""
+    st.set_page_config(
+        page_title="المعاهد العليا | Golden System",
+        layout="wide",
+        page_icon="🎓",
+        initial_sidebar_state="expanded"
+    )
+    st.markdown(PAGE_CSS, unsafe_allow_html=True)
 
 # --- ثوابت النظام ---
+def _cfg(key, default):
+    """قراءة إعداد من متغيرات البيئة أولاً ثم من secrets، مع الاحتفاظ بنوع القيمة الافتراضية"""
+    val = os.environ.get(key.upper())
+    if val is None:
+        try:
+            if key in st.secrets: val = st.secrets[key]
+        except Exception:
+            val = None
+    if val is None: return default
+    if isinstance(default, bool):
+        return str(val).strip().lower() in ("1", "true", "yes", "on")
+    try: return type(default)(val)
+    except (TypeError, ValueError): return default
+
 SHEET_NAME = "users_database"
+STORAGE_BACKEND = _cfg("storage_backend", "sheets")  # sheets | sqlite
+SQLITE_PATH = _cfg("sqlite_path", "users_database.db")
+DF_CACHE_TTL = _cfg("df_cache_ttl", 60)     # ثواني
+DF_CACHE_SIZE = _cfg("df_cache_size", 32)   # أقصى عدد جداول في الكاش
+LOGIN_INDEX_MAX_AGE = _cfg("login_index_max_age", 600)  # ثواني قبل إعادة بناء فهرس الدخول
+DATA_DIR = _cfg("data_dir", ".login_data")  # ملفات التشغيل المحلية (سجل الكتابة...)
+WRITE_FLUSH_INTERVAL = _cfg("write_flush_interval", 2.0)  # ثواني بين كل دفعة رفع
+WRITE_MAX_BACKOFF = _cfg("write_max_backoff", 60.0)
+WRITE_MAX_ATTEMPTS = _cfg("write_max_attempts", 5)  # للأخطاء الدائمة فقط (مش أخطاء الحصة)
+SNAPSHOT_INTERVAL = _cfg("snapshot_interval", 300)  # أقل مدة بين حفظ لقطتين لنفس الجدول (ثواني)
+API_CALL_BUDGET = _cfg("api_call_budget", 10)  # أقصى عدد طلبات جوجل مقبول في الـ rerun الواحد
+API_LOG_SIZE = _cfg("api_log_size", 20000)     # عدد الطلبات المحفوظة للتشخيص
+API_QUOTA_PER_MIN = _cfg("api_quota_per_min", 60)  # حصة Sheets لكل دقيقة (مشتركة بين كل الجلسات)
 BASE_TUITION = 18000
 BOOK_FEES_MAP = {1: 2000, 2: 2500, 3: 3000, 4: 3500}
 
@@ -70,10 +123,269 @@ HEADERS_TEACHER = [
 
 HEADERS_SUBJECTS = ["Subject_Name", "Teacher_Code", "Teacher_Name", "Year_Level", "Term"]
 
+# الدفتر الموحد (Ledger): سجل واحد لكل الطلاب بدل شيت لكل طالب
+# Ref = رقم العملية اللي كتبت القيد، والقيود المالية اللي ليها Ref هي اللي بتتحسب في الرصيد
+HEADERS_LEDGER = ["Code", "Kind", "Item", "Value", "Date", "Link", "Ref"]
+PAY_ITEMS = {"المصاريف": "Paid_Tuition", "الكتب": "Paid_Books"}  # قيد payment: بند الدفع -> عمود المدفوع
+CARRY_ITEMS = {"المصاريف": "Carried_Tuition", "الكتب": "Carried_Books"}  # قيد charge: مستحقات سنة خلصت (الترحيل)
+GRADE_OPTIONS = ["ناجح", "راسب", "امتياز", "جيد جداً"]
+CODE_PATTERN = r"^[A-Z]{1,2}\d{7}$"  # شكل أكواد gen_code (طالب: حرف، معلم: حرفين)
+
+# عناوين الشيت الخاص القديم (تستخدم في العرض وفي الترحيل)
+HEADERS_PERSONAL = ["البيان", "القيمة/الحالة", "التاريخ", "Link"]
+LEDGER_VIEW = dict(zip(["Item", "Value", "Date", "Link"], HEADERS_PERSONAL))
+
+SCHEMA_MAP = {
+    "Students_Main": HEADERS_STUDENT,
+    "Teachers_Main": HEADERS_TEACHER,
+    "Subjects_Data": HEADERS_SUBJECTS,
+    "Ledger": HEADERS_LEDGER
+}
+
+# جداول لا يحدث فيها إلا إضافة صفوف (تتحدث بالفرق بدل إعادة التحميل)
+APPEND_ONLY = {"Subjects_Data", "Ledger"}
+
+# جدول كل دور، والحقول اللي البوابات محتاجاها فقط بعد الدخول
+ROLE_SHEETS = {"Student": "Students_Main", "Teacher": "Teachers_Main"}
+PORTAL_FIELDS = {
+    "Student": ["Code", "Name", "Year", "Major", "Join_Date"],
+    "Teacher": ["Code", "Name", "Specialization", "Join_Date"],
+}
+# أعمدة بتتقري نص زي ما هي من الشيت (numericise بيشيل الصفر من أول التليفون وكلمات المرور الأرقام)
+TEXT_FIELDS = {"Code", "Password", "National_ID", "Phone", "Guardian_Phone", "Seat_Num", "Ref"}
+# أنواع الجدول المشترك في الذاكرة: قيم متكررة كـ category والمبالغ أرقام
+ROSTER_CATEGORIES = ["Year", "Major", "Governorate", "Certificate", "Nationality", "Religion"]
+ROSTER_MONEY = ["Paid_Tuition", "Paid_Books"]
+LEDGER_MONEY = ROSTER_MONEY + list(CARRY_ITEMS.values())
+
+# بصمة الهيكل: أي تعديل في العناوين يغير الرقم ويجبر على إعادة الفحص
+SCHEMA_VERSION = hashlib.sha1(
+    json.dumps([SCHEMA_MAP, HEADERS_PERSONAL], ensure_ascii=False, sort_keys=True).encode("utf-8")
+).hexdigest()[:12]
+
 # ---------------------------------------------------------
 # 2. المحرك الخلفي (The Engine)
 # ---------------------------------------------------------
 
+# --- مراقبة طلبات جوجل (API Instrumentation) ---
+
+# (البوابة، رقم الـ rerun) للطلبات الجارية؛ الخيوط الخلفية = background
+_API_SCOPE = contextvars.ContextVar("api_scope", default=("background", None))
+
+# أولوية الطلبات: الدخول والقراءة التفاعلية قبل الاستيراد الجماعي قبل الرفع في الخلفية
+API_PRIORITIES = {"interactive": 0, "bulk": 1, "background": 2}
+_API_PRIORITY = contextvars.ContextVar("api_priority", default="background")
+
+@contextmanager
+def api_priority(level):
+    """تشغيل مجموعة طلبات بأولوية معينة (مثلاً bulk للاستيراد الجماعي)"""
+    token = _API_PRIORITY.set(level)
+    try:
+        yield
+    finally:
+        _API_PRIORITY.reset(token)
+
+
+class ApiScheduler:
+    """
+    منظم طلبات مشترك لكل الجلسات: Token Bucket بنفس حصة Sheets،
+    وأي طلب مستني بياخد دوره حسب الأولوية ثم الأقدم.
+    """
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._cond = threading.Condition()
+        self._queue = []  # heap (أولوية، ترتيب)
+        self._seq = itertools.count()
+        self.waited = {p: 0.0 for p in API_PRIORITIES}
+        self.granted = {p: 0 for p in API_PRIORITIES}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def acquire(self, level):
+        ticket = (API_PRIORITIES.get(level, 0), next(self._seq))
+        t0 = time.monotonic()
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+            while True:
+                self._refill()
+                if self._queue[0] == ticket and self._tokens >= 1:
+                    heapq.heappop(self._queue)
+                    self._tokens -= 1
+                    self._cond.notify_all()
+                    break
+                wait = (1 - self._tokens) / self.rate if self._queue[0] == ticket else None
+                self._cond.wait(timeout=wait)
+            waited = time.monotonic() - t0
+            self.waited[level] = self.waited.get(level, 0.0) + waited
+            self.granted[level] = self.granted.get(level, 0) + 1
+        return waited
+
+    def status(self):
+        with self._cond:
+            self._refill()
+            waiting = {p: 0 for p in API_PRIORITIES}
+            names = {v: k for k, v in API_PRIORITIES.items()}
+            for prio, _ in self._queue:
+                waiting[names.get(prio, "interactive")] += 1
+            return {"tokens": round(self._tokens, 1), "waiting": waiting,
+                    "granted": dict(self.granted), "waited_s": {p: round(w, 2) for p, w in self.waited.items()}}
+
+
+class SingleFlight:
+    """طلبات قراءة متطابقة في نفس اللحظة بتستنى نتيجة تحميل واحد"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def fetch(self, keys, loader):
+        """loader(مفاتيح) -> dict؛ المفاتيح اللي حد تاني بيحملها بنستنى نتيجتها"""
+        mine, theirs = [], {}
+        with self._lock:
+            for k in keys:
+                call = self._inflight.get(k)
+                if call is None:
+                    self._inflight[k] = {"done": threading.Event(), "result": None}
+                    mine.append(k)
+                else:
+                    theirs[k] = call
+        out = {}
+        if mine:
+            try:
+                out.update(loader(mine))
+            finally:
+                with self._lock:
+                    for k in mine:
+                        call = self._inflight.pop(k)
+                        call["result"] = out.get(k)
+                        call["done"].set()
+        for k, call in theirs.items():
+            call["done"].wait()
+            if call["result"] is not None: out[k] = call["result"]
+        return out
+
+def _response_size(res):
+    """حجم الرد بعدد الخلايا (تقريبي)"""
+    if isinstance(res, dict):
+        return sum(_response_size(vr.get("values", [])) for vr in res.get("valueRanges", []))
+    if isinstance(res, list):
+        return sum(len(r) if isinstance(r, (list, dict)) else 1 for r in res)
+    return 0
+
+
+class ApiMonitor:
+    """سجل لكل طلب API: النوع، الشيت، الزمن، حجم الرد، والبوابة والـ rerun اللي طلبته"""
+
+    def __init__(self, maxlen):
+        self._calls = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def record(self, call, worksheet, latency, size, error=None, wait=0.0):
+        portal, rerun = _API_SCOPE.get()
+        with self._lock:
+            self._calls.append({
+                "ts": str(datetime.now()), "portal": portal, "rerun": rerun, "call": call,
+                "worksheet": worksheet, "latency_ms": round(latency * 1000, 1), "size": size, "error": error,
+                "priority": _API_PRIORITY.get(), "wait_ms": round(wait * 1000, 1),
+            })
+
+    def calls(self):
+        with self._lock:
+            return list(self._calls)
+
+    def count(self, rerun):
+        with self._lock:
+            return sum(1 for c in self._calls if c["rerun"] == rerun)
+
+    def clear(self):
+        with self._lock:
+            self._calls.clear()
+
+    def to_jsonl(self):
+        return "\n".join(json.dumps(c, ensure_ascii=False) for c in self.calls())
+
+
+class _Instrumented:
+    """غلاف شفاف حول كائنات gspread (client / spreadsheet / worksheet) يمرر كل طلب على المنظم ويسجله"""
+
+    def __init__(self, obj, monitor, scheduler, target=None):
+        self._obj = obj
+        self._monitor = monitor
+        self._scheduler = scheduler
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if name.startswith("_") or not callable(attr): return attr
+
+        def call(*args, **kwargs):
+            target = self._target
+            if name in ("open", "worksheet", "add_worksheet") and args: target = str(args[0])
+            elif name == "values_batch_get" and args:
+                target = ",".join(sorted({str(r).split("!")[0].strip("'") for r in args[0]}))
+            wait = self._scheduler.acquire(_API_PRIORITY.get())
+            t0 = time.perf_counter()
+            try:
+                res = attr(*args, **kwargs)
+            except Exception as e:
+                self._monitor.record(name, target, time.perf_counter() - t0, 0, type(e).__name__, wait)
+                raise
+            self._monitor.record(name, target, time.perf_counter() - t0, _response_size(res), wait=wait)
+            return self._wrap(name, res)
+        return call
+
+    def _wrap(self, name, res):
+        """أي حاجة بترجعها open / worksheet / worksheets بتتغلف حسب اسم الطلب (مش نوعها)"""
+        wrap = lambda obj, target: _Instrumented(obj, self._monitor, self._scheduler, target)
+        if name in ("open", "open_by_key", "open_by_url"): return wrap(res, SHEET_NAME)
+        if name in ("worksheet", "add_worksheet"): return wrap(res, getattr(res, "title", None))
+        if name == "worksheets": return [wrap(ws, getattr(ws, "title", None)) for ws in res]
+        return res
+
+
+@st.cache_resource
+def get_api_monitor():
+    return ApiMonitor(API_LOG_SIZE)
+
+@st.cache_resource
+def get_api_scheduler():
+    return ApiScheduler(API_QUOTA_PER_MIN)
+
+@st.cache_resource
+def get_single_flight():
+    return SingleFlight()
+
+def begin_rerun(portal):
+    """تحديد البوابة ورقم الـ rerun لكل الطلبات اللي هتحصل في التشغيل ده"""
+    if '_sid' not in st.session_state:
+        st.session_state['_sid'] = uuid.uuid4().hex[:6]
+        st.session_state['_rerun'] = 0
+    st.session_state['_rerun'] += 1
+    rerun = f"{st.session_state['_sid']}-{st.session_state['_rerun']}"
+    _API_SCOPE.set((portal, rerun))
+    _API_PRIORITY.set("interactive")
+    return rerun
+
+def check_rerun_budget(rerun):
+    """تحذير لو الـ rerun عدى ميزانية الطلبات"""
+    n = get_api_monitor().count(rerun)
+    if n > API_CALL_BUDGET:
+        portal = _API_SCOPE.get()[0]
+        logger.warning("api budget: %s rerun %s made %d calls (budget %d)", portal, rerun, n, API_CALL_BUDGET)
+        if st.session_state.get('role') == "Admin":
+            st.toast(f"⚠️ هذا التحديث استهلك {n} طلب من جوجل (الحد {API_CALL_BUDGET})")
+
+def instrument(client):
+    """تغليف الـ client (الحقيقي أو الوهمي في الـ benchmark) بالمراقبة ومنظم الحصة المشترك"""
+    return _Instrumented(client, get_api_monitor(), get_api_scheduler())
+
 @st.cache_resource
 def get_client():
     """الاتصال بجوجل مرة واحدة فقط (كاش) لسرعة الأداء"""
@@ -84,8 +396,7 @@ def get_client():
             if "private_key" in creds_dict:
                 creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
             creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-            client = gspread.authorize(creds)
-            return client
+            return instrument(gspread.authorize(creds))
         else:
             st.error("⚠️ لم يتم العثور على أسرار الاتصال (Secrets).")
             return None
@@ -93,61 +404,1242 @@ def get_client():
         st.error(f"خطأ اتصال: {e}")
         return None
 
+# --- طبقة التخزين (Storage Backends) ---
+# كل قراءة وكتابة في النظام تمر من خلال get_storage()، والمحرك يتحدد من الإعدادات:
+# sheets: جوجل شيت مباشرة | sqlite: قاعدة محلية مفهرسة، وجوجل شيت يصبح هدف مزامنة اختياري
+
+def safe_num(v):
+    """تحويل مبلغ مكتوب في الشيت (ممكن فيه فواصل) لرقم صحيح، وأي قيمة غير رقمية = 0"""
+    return int(str(v).replace(',','')) if str(v).replace(',','').isdigit() else 0
+
+def col_of(ws_name, field):
+    """رقم العمود (من 1) حسب ترتيب العناوين، بدل الأرقام الثابتة"""
+    return SCHEMA_MAP[ws_name].index(field) + 1
+
+def _records_df(values):
+    """نفس ناتج get_all_records من قيم خام (الصف الأول عناوين، والأرقام تتحول لأرقام ماعدا TEXT_FIELDS)"""
+    if not values: return pd.DataFrame()
+    header, body = values[0], values[1:]
+    width = len(header)
+    text = [i for i, h in enumerate(header) if h in TEXT_FIELDS]
+    rows = []
+    for r in body:
+        raw = (r + [""] * width)[:width]
+        row = gspread.utils.numericise_all(raw, default_blank="")
+        for i in text: row[i] = raw[i]
+        rows.append(row)
+    return pd.DataFrame(rows, columns=header)
+
+def _is_boilerplate(values):
+    """صف "هذا السجل رسمي" اللي كان بيتكتب في كل شيت خاص - بقى بيتعرض ثابت في البوابة"""
+    return len(values) >= 2 and values[0] == "تنبيه" and values[1] == "هذا السجل رسمي"
+
+def ledger_row_from_personal(code, values):
+    """تحويل صف من الشيت الخاص القديم (البيان، القيمة، التاريخ، Link) لقيد في الدفتر"""
+    values = ["" if v is None else str(v) for v in (list(values) + ["", "", "", ""])[:4]]
+    item = values[0]
+    if item.startswith("نتيجة"): kind = "grade"
+    elif item in ("المصاريف", "الكتب"): kind = "payment"
+    else: kind = "notice"
+    # بدون Ref: المدفوع القديم محسوب بالفعل في خلية الرصيد
+    return [str(code).strip(), kind] + values + [""]
+
+def row_key(ws_name, row):
+    """الصف كنصوص منظفة بعرض عناوين الجدول (للمقارنة بين المكتوب والموجود)"""
+    width = len(SCHEMA_MAP[ws_name])
+    return tuple(str(v).strip() for v in (list(row) + [""] * width)[:width])
+
+class StorageBackend:
+    """الواجهة الموحدة لمحركات التخزين"""
+    name = ""
+    indexed = False  # True = القراءة المفلترة بالكود رخيصة (فهرس محلي)
+
+    def ensure_schema(self):
+        """التأكد من وجود الجداول والعناوين، ويرجع قائمة (الجدول، الخطأ) للمشاكل"""
+        raise NotImplementedError
+
+    def read(self, ws_name):
+        raise NotImplementedError
+
+    def read_many(self, ws_names):
+        """قراءة أكثر من جدول مرة واحدة، ويرجع dict اسم -> DataFrame"""
+        return {n: self.read(n) for n in ws_names}
+
+    def read_delta(self, ws_name, cached):
+        """
+        الصفوف المضافة بعد آخر نسخة (cached) فقط؛
+        يرجع None لو العناوين اتغيرت أو الصفوف قلت (لازم تحميل كامل)
+        """
+        return None
+
+    def codes(self, ws_name):
+        raise NotImplementedError
+
+    def append(self, ws_name, row):
+        raise NotImplementedError
+
+    def update_value(self, ws_name, code, field, value):
+        raise NotImplementedError
+
+    def replace_table(self, ws_name, df):
+        raise NotImplementedError
+
+    def read_ledger(self, code):
+        """قيود طالب واحد من الدفتر (الافتراضي: قراءة كاملة ثم فلترة)"""
+        df = self.read("Ledger")
+        if df.empty: return df
+        return df[df["Code"].astype(str).str.strip() == str(code).strip()]
+
+    def migrate_to_ledger(self, delete_old=False):
+        """ترحيل السجلات الفردية القديمة إلى الدفتر، ويرجع عدد القيود المرحلة"""
+        raise NotImplementedError
+
+    def existing_refs(self, refs):
+        """أرقام العمليات (Ref) اللي ليها قيد في الدفتر بالفعل من بين refs"""
+        df = self.read("Ledger")
+        if df.empty or "Ref" not in df.columns: return set()
+        return set(df["Ref"].astype(str)) & set(refs)
+
+    def existing_rows(self, ws_name, rows):
+        """
+        عدد مرات وجود كل صف من rows في الجدول بالفعل (مفتاح row_key)،
+        للجداول اللي مفيهاش Ref: الطابور بيفحص بيه الإضافات اللي ممكن تكون وصلت قبل ما يعيدها
+        """
+        df = self.read(ws_name)
+        if df.empty: return Counter()
+        wanted = {row_key(ws_name, r) for r in rows}
+        table = df.reindex(columns=SCHEMA_MAP[ws_name]).fillna("").astype(str).values.tolist()
+        return Counter(k for k in (row_key(ws_name, r) for r in table) if k in wanted)
+
+    # عمليات مجمعة (يستخدمها طابور الكتابة) - الافتراضي صف بصف
+    def append_rows(self, ws_name, rows):
+        for row in rows: self.append(ws_name, row)
+
+    def batch_update(self, ws_name, updates):
+        for code, field, value in updates: self.update_value(ws_name, code, field, value)
+
+
+class SheetsBackend(StorageBackend):
+    """التخزين على Google Sheets (شيت لكل جدول)"""
+    name = "sheets"
+
+    def __init__(self, client):
+        self.client = client
+        # خريطة كود -> رقم الصف للجداول الرئيسية (بدل ws.find اللي بيمسح الشيت كله)
+        self._rows = {}
+        self._nrows = {}
+        self._index_lock = threading.Lock()
+        # مقبض الملف والشيتات يتفتح مرة واحدة (كل open / worksheet طلب API)
+        self._handle = None
+        self._worksheets = {}
+        self._handle_lock = threading.Lock()
+
+    def _sheet(self):
+        with self._handle_lock:
+            if self._handle is None:
+                self._handle = self.client.open(SHEET_NAME)
+            return self._handle
+
+    def _ws(self, ws_name):
+        ws = self._worksheets.get(ws_name)
+        if ws is None:
+            ws = self._sheet().worksheet(ws_name)
+            self._worksheets[ws_name] = ws
+        return ws
+
+    def reset(self):
+        """نسيان المقابض المحفوظة (بعد إعادة فحص الهيكل أو حذف/إضافة شيتات)"""
+        with self._handle_lock:
+            self._handle = None
+            self._worksheets = {}
+
+    def _row_map(self, ws_name, refresh=False):
+        with self._index_lock:
+            if refresh or ws_name not in self._rows:
+                codes = self._ws(ws_name).col_values(1)
+                self._rows[ws_name] = {str(c).strip(): i + 1 for i, c in enumerate(codes) if i > 0}
+                self._nrows[ws_name] = len(codes)
+            return self._rows[ws_name]
+
+    def _row_of(self, ws_name, code, refresh=False):
+        row = self._row_map(ws_name, refresh).get(str(code).strip())
+        if row is None and not refresh:
+            return self._row_of(ws_name, code, refresh=True)
+        if row is None: raise KeyError(code)
+        return row
+
+    def _note_appended(self, ws_name, rows):
+        """تحديث الخريطة بعد الإضافة بدون إعادة تحميل العمود"""
+        if ws_name not in ROLE_SHEETS.values(): return
+        with self._index_lock:
+            if ws_name not in self._rows: return
+            for row in rows:
+                self._nrows[ws_name] += 1
+                self._rows[ws_name][str(row[0]).strip()] = self._nrows[ws_name]
+
+    def ensure_schema(self):
+        self.reset()
+        sheet = self._sheet()
+        issues = []
+        for ws_name, expected in SCHEMA_MAP.items():
+            try:
+                try: ws = sheet.worksheet(ws_name)
+                except: ws = sheet.add_worksheet(ws_name, 1000, len(expected))
+
+                # فحص الصف الأول
+                current = ws.row_values(1)
+
+                # إذا كان مختلفاً عن المتوقع، نقوم بإعادة الكتابة
+                if current != expected:
+                    ws.resize(cols=len(expected))
+                    cell_list = ws.range(1, 1, 1, len(expected))
+                    for i, cell in enumerate(cell_list):
+                        cell.value = expected[i]
+                    ws.update_cells(cell_list)
+            except Exception as e:
+                issues.append((ws_name, e))
+        return issues
+
+    def read(self, ws_name):
+        return self.read_many([ws_name])[ws_name]
+
+    def read_many(self, ws_names):
+        # كل الجداول في طلب values:batchGet واحد
+        resp = self._sheet().values_batch_get([f"'{n}'" for n in ws_names])
+        return {n: _records_df(vr.get("values", [])) for n, vr in zip(ws_names, resp.get("valueRanges", []))}
+
+    def read_delta(self, ws_name, cached):
+        n = len(cached)
+        last_col = gspread.utils.rowcol_to_a1(1, len(cached.columns)).rstrip("1")
+        # العناوين + آخر صف معروف (صف n+1 في الشيت) وما بعده، في طلب واحد
+        resp = self._sheet().values_batch_get([f"'{ws_name}'!1:1", f"'{ws_name}'!A{n + 1}:{last_col}"])
+        header_vr, tail_vr = resp.get("valueRanges", [{}, {}])
+        header = (header_vr.get("values") or [[]])[0]
+        if header != list(cached.columns): return None
+        tail = _records_df([header] + tail_vr.get("values", []))
+        if tail.empty: return None  # الصفوف قلت
+        anchor = [str(v) for v in tail.iloc[0].tolist()]
+        if anchor != [str(v) for v in cached.iloc[-1].tolist()]: return None
+        return tail.iloc[1:]
+
+    def codes(self, ws_name):
+        return self._ws(ws_name).col_values(1)
+
+    def existing_refs(self, refs):
+        # عمود Ref بس في طلب واحد
+        return set(map(str, self._ws("Ledger").col_values(col_of("Ledger", "Ref")))) & set(refs)
+
+    def append(self, ws_name, row):
+        self._ws(ws_name).append_row(row)
+        self._note_appended(ws_name, [row])
+
+    def update_value(self, ws_name, code, field, value):
+        self.batch_update(ws_name, [(code, field, value)])
+
+    def replace_table(self, ws_name, df):
+        ws = self._ws(ws_name)
+        headers = SCHEMA_MAP[ws_name]
+        rows = df.reindex(columns=headers).fillna("").astype(str).values.tolist()
+        ws.clear()
+        ws.update(values=[headers] + rows, range_name="A1")
+
+    def migrate_to_ledger(self, delete_old=False, chunk=100):
+        sheet = self._sheet()
+        tabs = [ws for ws in sheet.worksheets() if re.match(CODE_PATTERN, ws.title)]
+        ledger = self.read("Ledger")
+        seen = set()
+        if not ledger.empty:
+            seen = set(zip(*(ledger[c].astype(str) for c in ("Code", "Item", "Date"))))
+        rows = []
+        # طلب واحد لكل مجموعة شيتات بدل طلب لكل طالب
+        for i in range(0, len(tabs), chunk):
+            part = tabs[i:i + chunk]
+            resp = sheet.values_batch_get([f"'{ws.title}'!A:D" for ws in part])
+            for ws, vr in zip(part, resp.get("valueRanges", [])):
+                for values in vr.get("values", []):
+                    if values[:len(HEADERS_PERSONAL)] == HEADERS_PERSONAL or _is_boilerplate(values):
+                        continue
+                    row = ledger_row_from_personal(ws.title, values)
+                    if (row[0], row[2], row[4]) not in seen:
+                        rows.append(row)
+        if rows: self.append_rows("Ledger", rows)
+        if delete_old and tabs:
+            # كل الشيتات القديمة في طلب batchUpdate واحد بدل طلب لكل شيت
+            sheet.batch_update({"requests": [{"deleteSheet": {"sheetId": ws.id}} for ws in tabs]})
+            self.reset()
+        return len(rows)
+
+    def append_rows(self, ws_name, rows):
+        self._ws(ws_name).append_rows(rows)
+        self._note_appended(ws_name, rows)
+
+    def batch_update(self, ws_name, updates):
+        ws = self._ws(ws_name)
+        for attempt in range(2):
+            if attempt: self._row_map(ws_name, refresh=True)
+            rows = [self._row_of(ws_name, code) for code, _, _ in updates]
+            # التأكد في طلب واحد إن الخريطة لسه مطابقة (لو حد مسح صفوف يدوياً)
+            found = ws.batch_get([f"A{r}" for r in rows])
+            if all(v and str(v[0][0]).strip() == str(c).strip() for v, (c, _, _) in zip(found, updates)):
+                break
+        else:
+            raise KeyError("row index mismatch")
+        ws.batch_update([
+            {"range": gspread.utils.rowcol_to_a1(r, col_of(ws_name, field)), "values": [[value]]}
+            for r, (_, field, value) in zip(rows, updates)
+        ])
+
+
+class SQLiteBackend(StorageBackend):
+    """التخزين المحلي على SQLite بنفس العناوين مع فهارس على الكود"""
+    name = "sqlite"
+    indexed = True
+    INDEXES = {
+        "Students_Main": [("Code", True)],
+        "Teachers_Main": [("Code", True)],
+        "Subjects_Data": [("Teacher_Code", False), ("Year_Level", False)],
+        "Ledger": [("Code", False), ("Kind", False), ("Ref", False)],
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+    def ensure_schema(self):
+        issues = []
+        with self._lock:
+            for table, cols in SCHEMA_MAP.items():
+                try:
+                    with self.conn:
+                        # أعمدة بدون نوع = القيمة تتخزن كما هي (نفس سلوك الشيت)
+                        col_sql = ", ".join(f'"{c}"' for c in cols)
+                        self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({col_sql})')
+                        current = [r[1] for r in self.conn.execute(f'PRAGMA table_info("{table}")')]
+                        for c in cols:
+                            if c not in current:
+                                self.conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{c}"')
+                        for col, unique in self.INDEXES.get(table, []):
+                            kind = "UNIQUE INDEX" if unique else "INDEX"
+                            self.conn.execute(
+                                f'CREATE {kind} IF NOT EXISTS "idx_{table}_{col}" ON "{table}" ("{col}")'
+                            )
+                except Exception as e:
+                    issues.append((table, e))
+        return issues
+
+    def read(self, ws_name):
+        cols = ", ".join(f'"{c}"' for c in SCHEMA_MAP[ws_name])
+        with self._lock:
+            return pd.read_sql_query(f'SELECT {cols} FROM "{ws_name}" ORDER BY rowid', self.conn)
+
+    def read_delta(self, ws_name, cached):
+        if list(cached.columns) != SCHEMA_MAP[ws_name]: return None
+        cols = ", ".join(f'"{c}"' for c in SCHEMA_MAP[ws_name])
+        with self._lock:
+            total = self.conn.execute(f'SELECT COUNT(*) FROM "{ws_name}"').fetchone()[0]
+            if total < len(cached): return None
+            return pd.read_sql_query(
+                f'SELECT {cols} FROM "{ws_name}" ORDER BY rowid LIMIT -1 OFFSET ?',
+                self.conn, params=(len(cached),)
+            )
+
+    def codes(self, ws_name):
+        with self._lock:
+            return [r[0] for r in self.conn.execute(f'SELECT "Code" FROM "{ws_name}"')]
+
+    @staticmethod
+    def _insert_sql(ws_name):
+        """INSERT بأسماء الأعمدة صراحة: عمود اتضاف بـ ALTER بيتحط في الآخر مش مكانه في الهيدر"""
+        headers = SCHEMA_MAP[ws_name]
+        cols = ", ".join(f'"{c}"' for c in headers)
+        return f'INSERT INTO "{ws_name}" ({cols}) VALUES ({", ".join("?" * len(headers))})'
+
+    @staticmethod
+    def _fit(ws_name, rows):
+        """كل صف بطول الهيدر بالظبط (صفوف قديمة أقصر بتتكمل بقيم فاضية)"""
+        width = len(SCHEMA_MAP[ws_name])
+        return [(list(r) + [""] * width)[:width] for r in rows]
+
+    def append(self, ws_name, row):
+        self.append_rows(ws_name, [row])
+
+    def update_value(self, ws_name, code, field, value):
+        with self._lock, self.conn:
+            cur = self.conn.execute(
+                f'UPDATE "{ws_name}" SET "{field}" = ? WHERE "Code" = ?', (value, str(code))
+            )
+        if cur.rowcount == 0:
+            raise KeyError(code)
+
+    def replace_table(self, ws_name, df):
+        headers = SCHEMA_MAP[ws_name]
+        rows = df.reindex(columns=headers).fillna("").values.tolist()
+        with self._lock, self.conn:
+            self.conn.execute(f'DELETE FROM "{ws_name}"')
+            self.conn.executemany(self._insert_sql(ws_name), rows)
+
+    def existing_refs(self, refs):
+        refs, found = list(refs), set()
+        with self._lock:
+            for i in range(0, len(refs), 500):
+                part = refs[i:i + 500]
+                marks = ", ".join("?" * len(part))
+                found.update(r[0] for r in self.conn.execute(
+                    f'SELECT "Ref" FROM "Ledger" WHERE "Ref" IN ({marks})', part
+                ))
+        return found
+
+    def read_ledger(self, code):
+        cols = ", ".join(f'"{c}"' for c in HEADERS_LEDGER)
+        with self._lock:
+            return pd.read_sql_query(
+                f'SELECT {cols} FROM "Ledger" WHERE "Code" = ? ORDER BY rowid',
+                self.conn, params=(str(code).strip(),)
+            )
+
+    def migrate_to_ledger(self, delete_old=True):
+        """SQLite اتعمل من الأول بالدفتر الموحد، فمفيش سجلات فردية قديمة تترحل"""
+        return 0
+
+    def append_rows(self, ws_name, rows):
+        with self._lock, self.conn:
+            self.conn.executemany(self._insert_sql(ws_name), self._fit(ws_name, rows))
+
+    def batch_update(self, ws_name, updates):
+        with self._lock, self.conn:
+            for code, field, value in updates:
+                cur = self.conn.execute(
+                    f'UPDATE "{ws_name}" SET "{field}" = ? WHERE "Code" = ?', (value, str(code))
+                )
+                # أي كود ناقص يلغي الدفعة كلها (rollback)
+                if cur.rowcount == 0: raise KeyError(code)
+
+
+@st.cache_resource
+def get_storage():
+    """اختيار محرك التخزين مرة واحدة فقط حسب الإعدادات (sheets / sqlite)"""
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteBackend(SQLITE_PATH)
+    client = get_client()
+    if not client: return None
+    return SheetsBackend(client)
+
+def sync_to_sheets():
+    """رفع الجداول الرئيسية من القاعدة المحلية إلى جوجل شيت (نسخة مطابقة)"""
+    storage = get_storage()
+    client = get_client()
+    if not storage or not client or storage.name == "sheets": return False
+    remote = SheetsBackend(client)
+    remote.ensure_schema()
+    for ws_name in SCHEMA_MAP:
+        remote.replace_table(ws_name, storage.read(ws_name))
+    return True
+
 def auto_fix_schema():
     """
     🛠️ المصلح الذكي (Self-Healing):
     يفحص الملف عند البدء، ويصلح أي عناوين مكررة أو ناقصة تلقائياً.
     """
-    client = get_client()
-    if not client: return False
-    
+    storage = get_storage()
+    if not storage: return False
+
     try:
-        sheet = client.open(SHEET_NAME)
+        issues = storage.ensure_schema()
     except:
         st.error(f"الملف {SHEET_NAME} غير موجود!")
         return False
 
-    schema_map = {
-        "Students_Main": HEADERS_STUDENT,
-        "Teachers_Main": HEADERS_TEACHER,
-        "Subjects_Data": HEADERS_SUBJECTS
-    }
+    for ws_name, e in issues:
+        st.warning(f"جاري تهيئة {ws_name}... {e}")
 
-    for ws_name, expected in schema_map.items():
-        try:
-            try: ws = sheet.worksheet(ws_name)
-            except: ws = sheet.add_worksheet(ws_name, 1000, len(expected))
-            
-            # فحص الصف الأول
-            current = ws.row_values(1)
-            
-            # إذا كان مختلفاً عن المتوقع، نقوم بإعادة الكتابة
-            if current != expected:
-                ws.resize(cols=len(expected))
-                cell_list = ws.range(1, 1, 1, len(expected))
-                for i, cell in enumerate(cell_list):
-                    cell.value = expected[i]
-                ws.update_cells(cell_list)
-        except Exception as e:
-            st.warning(f"جاري تهيئة {ws_name}... {e}")
-            
     return True
 
-def get_df(ws_name):
-    """جلب البيانات كـ DataFrame"""
-    client = get_client()
-    if not client: return pd.DataFrame()
+# --- فحص الهيكل مرة واحدة لكل عملية (Schema Check Once) ---
+
+class SchemaState:
+    """آخر بصمة هيكل تم التحقق منها في هذه العملية"""
+
+    def __init__(self):
+        self.version = None
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+
+@st.cache_resource
+def get_schema_state():
+    return SchemaState()
+
+def ensure_schema(force=False):
+    """تشغيل auto_fix_schema عند البدء فقط، أو عند تغير البصمة، أو بطلب من الإدارة"""
+    state = get_schema_state()
+    if not force and state.version == SCHEMA_VERSION: return True
+    with state.lock:
+        if not force and state.version == SCHEMA_VERSION: return True
+        ok = auto_fix_schema()
+        if ok:
+            state.version = SCHEMA_VERSION
+            state.checked_at = datetime.now()
+        return ok
+
+def mark_schema_dirty():
+    get_schema_state().version = None
+
+def _is_schema_error(e):
+    """أخطاء تدل على أن الجدول أو الأعمدة مش مطابقة للهيكل المتوقع"""
+    if isinstance(e, (sqlite3.OperationalError, gspread.exceptions.WorksheetNotFound, ValueError)):
+        return True
+    return "column" in str(e).lower()
+
+@contextmanager
+def schema_guard():
+    """أي كتابة تفشل بسبب الهيكل تجعل الفحص القادم إجبارياً"""
+    try:
+        yield
+    except Exception as e:
+        if _is_schema_error(e): mark_schema_dirty()
+        raise
+
+# --- طابور الكتابة المؤجلة (Write-Behind Queue) ---
+
+def _is_quota_error(e):
+    """خطأ 429 من جوجل (تجاوز الحصة) - يستاهل إعادة المحاولة بدون حد"""
+    resp = getattr(e, "response", None)
+    if getattr(resp, "status_code", None) == 429: return True
+    msg = str(e)
+    return "429" in msg or "RATE_LIMIT" in msg or "Quota exceeded" in msg
+
+
+class WriteQueue:
+    """
+    طابور كتابة مؤجلة بسجل على القرص (Journal):
+    الزرار يرجع فوراً، والعمليات بتتجمع لكل جدول وتترفع في الخلفية كدفعة واحدة
+    مع تأخير متزايد (Exponential Backoff) عند أخطاء الحصة، فلا تضيع أي كتابة.
+    """
+
+    def __init__(self, storage, journal_path, cache, interval=WRITE_FLUSH_INTERVAL):
+        self.storage = storage
+        self.path = journal_path
+        self.dead_path = journal_path + ".failed"
+        self.cache = cache
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._pending = []
+        self._attempts = {}
+        self._unsure = set()  # عمليات ممكن تكون وصلت قبل كده (من السجل أو بعد خطأ) - لازم فحص قبل الإعادة
+        self._backoff = 0.0
+        self._next_try = 0.0
+        self.last_flush = None
+        self.last_error = None
+        self.failed = self._count_lines(self.dead_path)
+        self._load()
+        threading.Thread(target=self._run, name="write-behind", daemon=True).start()
+
+    @staticmethod
+    def _count_lines(path):
+        if not os.path.exists(path): return 0
+        with open(path, encoding="utf-8") as f:
+            return sum(1 for _ in f)
+
+    def _load(self):
+        """استرجاع العمليات اللي ماترفعتش قبل آخر توقف"""
+        if not os.path.exists(self.path): return
+        ops, acked = {}, set()
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try: rec = json.loads(line)
+                except ValueError: continue  # سطر ناقص من توقف مفاجئ
+                if "ack" in rec: acked.update(rec["ack"])
+                else: ops[rec["id"]] = rec
+        self._pending = [op for op_id, op in ops.items() if op_id not in acked]
+        self._unsure = {op["id"] for op in self._pending}
+        self._compact()
+
+    def _append_lines(self, path, recs):
+        with open(path, "a", encoding="utf-8") as f:
+            for rec in recs:
+                f.write(json.dumps(rec, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _compact(self):
+        """إعادة كتابة السجل بالعمليات المعلقة فقط"""
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for op in self._pending:
+                f.write(json.dumps(op, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def submit(self, op, **fields):
+        """تسجيل عملية (append / payment) في السجل ثم الطابور"""
+        rec = {"id": uuid.uuid4().hex, "op": op, "ts": str(datetime.now()), **fields}
+        with self._cond:
+            self._append_lines(self.path, [rec])
+            self._pending.append(rec)
+        return rec["id"]
+
+    def submit_many(self, op, items):
+        """تسجيل دفعة عمليات بكتابة واحدة على السجل (fsync مرة واحدة)"""
+        now = str(datetime.now())
+        recs = [{"id": uuid.uuid4().hex, "op": op, "ts": now, **fields} for fields in items]
+        with self._cond:
+            self._append_lines(self.path, recs)
+            self._pending.extend(recs)
+        return [rec["id"] for rec in recs]
+
+    def flush_now(self):
+        with self._cond:
+            self._next_try = 0.0
+            self._cond.notify()
+
+    def status(self):
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "failed": self.failed,
+                "last_flush": self.last_flush,
+                "last_error": self.last_error,
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait(timeout=max(self.interval, self._next_try - time.monotonic()))
+                if not self._pending or time.monotonic() < self._next_try: continue
+                batch = list(self._pending)
+            self._flush(batch)
+
+    def _apply(self, kind, target, ops):
+        # الرفع at-least-once: أي عملية ممكن تكون اتكتبت قبل كده (_unsure) بتتفحص عشان ماتتكتبش مرتين
+        unsure = [op for op in ops if op["id"] in self._unsure]
+        if target == "Ledger":
+            # قيود الدفتر (دفع وتقديرات) برقم العملية في عمود Ref، وقيد الدفع هو الرصيد نفسه
+            applied = self.storage.existing_refs([op["id"] for op in unsure]) if unsure else set()
+            width = len(HEADERS_LEDGER) - 1
+            rows = [(list(op["row"]) + [""] * width)[:width] + [op["id"]] for op in ops if op["id"] not in applied]
+        else:
+            # باقي الجداول مفيهاش Ref: صف مطابق موجود بالفعل = العملية وصلت
+            present = self.storage.existing_rows(target, [op["row"] for op in unsure]) if unsure else Counter()
+            rows = []
+            for op in ops:
+                key = row_key(target, op["row"])
+                if op["id"] in self._unsure and present[key] > 0:
+                    present[key] -= 1
+                    continue
+                rows.append(op["row"])
+        if rows: self.storage.append_rows(target, rows)
+        self.cache.invalidate(target)
+
+    def _flush(self, batch):
+        groups = OrderedDict()
+        for op in batch:
+            groups.setdefault((op["op"], op["ws"]), []).append(op)
+
+        done, dead, error = [], [], None
+        for (kind, target), ops in groups.items():
+            try:
+                self._apply(kind, target, ops)
+                done += ops
+            except Exception as e:
+                error = e
+                if _is_quota_error(e): break  # باقي الدفعات هتفشل برضه
+                # خطأ بعد ما الطلب اتبعت (timeout مثلاً): القيد ممكن يكون اتكتب
+                self._unsure.update(op["id"] for op in ops)
+                if _is_schema_error(e): mark_schema_dirty()
+                for op in ops:
+                    self._attempts[op["id"]] = self._attempts.get(op["id"], 0) + 1
+                    if self._attempts[op["id"]] >= WRITE_MAX_ATTEMPTS: dead.append(op)
+
+        finished = {op["id"] for op in done + dead}
+        with self._cond:
+            if done: self._append_lines(self.path, [{"ack": [op["id"] for op in done]}])
+            if dead:
+                self._append_lines(self.dead_path, [dict(op, error=str(error)) for op in dead])
+                self._append_lines(self.path, [{"ack": [op["id"] for op in dead]}])
+                self.failed += len(dead)
+            self._pending = [op for op in self._pending if op["id"] not in finished]
+            for op_id in finished:
+                self._attempts.pop(op_id, None)
+                self._unsure.discard(op_id)
+            if error is None:
+                self._backoff = 0.0
+                self.last_flush = datetime.now()
+                self.last_error = None
+            else:
+                self._backoff = min(max(self._backoff * 2, 1.0), WRITE_MAX_BACKOFF)
+                self._next_try = time.monotonic() + self._backoff * random.uniform(0.8, 1.2)
+                self.last_error = f"{type(error).__name__}: {error}"
+            if not self._pending: self._compact()
+
+
+@st.cache_resource
+def get_write_queue():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return WriteQueue(get_storage(), os.path.join(DATA_DIR, "write_journal.jsonl"), get_df_cache())
+
+def render_write_status():
+    """حالة الكتابة المؤجلة في الشريط الجانبي"""
+    q = get_write_queue()
+    s = q.status()
+    if s["pending"]:
+        st.sidebar.info(f"⏳ عمليات في انتظار الرفع: {s['pending']}")
+        if s["last_error"]: st.sidebar.caption(f"آخر خطأ: {s['last_error']}")
+    else:
+        st.sidebar.success("✅ كل العمليات مرفوعة")
+    if s["failed"]:
+        st.sidebar.error(f"عمليات فشلت نهائياً: {s['failed']} (محفوظة في {q.dead_path})")
+
+# --- كاش القراءة المشترك (Shared Read Cache) ---
+
+class DataFrameCache:
+    """
+    كاش مشترك بين كل الجلسات: صلاحية زمنية (TTL) + حد أقصى مع طرد الأقدم استخداماً (LRU).
+    جداول keep_stale (الإضافة فقط) بتفضل محفوظة بعد انتهاء الصلاحية عشان تتحدث بالفرق (delta).
+    """
+
+    def __init__(self, ttl, maxsize, keep_stale=()):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.keep_stale = set(keep_stale)
+        self._data = OrderedDict()  # ws_name -> (وقت التحميل، df)
+        self._derived = {}  # (ws_name، اسم) -> (df، القيمة المحسوبة منه)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None: return None
+            loaded_at, df = item
+            if time.monotonic() - loaded_at > self.ttl:
+                if key not in self.keep_stale: del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return df
+
+    def peek(self, key):
+        """آخر نسخة محفوظة حتى لو منتهية الصلاحية"""
+        with self._lock:
+            item = self._data.get(key)
+            return item[1] if item else None
+
+    def put(self, key, df):
+        with self._lock:
+            self._data[key] = (time.monotonic(), df)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            live = {id(item[1]) for item in self._data.values()}
+            self._derived = {k: v for k, v in self._derived.items() if id(v[0]) in live}
+
+    def derive(self, key, name, fn):
+        """fn(الجدول المخزن) بتتحسب مرة واحدة لكل نسخة من الجدول (فهارس وتجميعات للقراءة فقط)"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None: return None
+            df = item[1]
+            memo = self._derived.get((key, name))
+            if memo is not None and memo[0] is df: return memo[1]
+        val = fn(df)
+        with self._lock:
+            self._derived[(key, name)] = (df, val)
+        return val
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+                self._derived.clear()
+            elif key in self.keep_stale and key in self._data:
+                self._data[key] = (float("-inf"), self._data[key][1])
+            else:
+                self._data.pop(key, None)
+                self._derived = {k: v for k, v in self._derived.items() if k[0] != key}
+
+
+@st.cache_resource
+def get_df_cache():
+    return DataFrameCache(DF_CACHE_TTL, DF_CACHE_SIZE, keep_stale=APPEND_ONLY)
+
+def invalidate_df(*ws_names):
+    """إلغاء الكاش بعد أي كتابة على الجدول (بدون أسماء = مسح الكل)"""
+    cache = get_df_cache()
+    if not ws_names: cache.invalidate()
+    for ws_name in ws_names:
+        cache.invalidate(ws_name)
+
+def compact_roster(df):
+    """
+    تحويل جدول الطلاب/المعلمين لأنواع مضغوطة قبل ما يدخل الكاش المشترك:
+    الكود نص منظف، الأعمدة المتكررة category، والمبالغ int64.
+    """
+    if df.empty: return df
+    df = df.copy()
+    if "Code" in df.columns:
+        df["Code"] = df["Code"].astype(str).str.strip()
+    for col in ROSTER_CATEGORIES:
+        if col in df.columns:
+            df[col] = df[col].astype(str).str.strip().astype("category")
+    for col in ROSTER_MONEY:
+        if col in df.columns:
+            df[col] = _money(df[col])
+    return df
+
+def _compact(ws_name, df):
+    return compact_roster(df) if ws_name in ROLE_SHEETS.values() else df
+
+def _refresh(cache, storage, ws_names, snapshots, force_save=False):
+    """تحميل الجداول من المحرك (بالفرق لجداول الإضافة فقط) وتحديث الكاش واللقطة"""
+    out = {}
+    missing = list(ws_names)
+    for n in [n for n in missing if n in APPEND_ONLY]:
+        df = _delta_refresh(cache, storage, n)
+        if df is not None:
+            out[n] = df
+            missing.remove(n)
+    if missing:
+        try:
+            fetched = storage.read_many(missing)
+        except:
+            fetched = {}
+        for n in missing:
+            if fetched.get(n) is None: continue
+            out[n] = _compact(n, fetched[n])
+            cache.put(n, out[n])
+    for n, df in out.items():
+        snapshots.maybe_save(n, df, force=force_save)
+    return out
+
+def _shared_dfs(ws_names):
+    """الجداول المشتركة نفسها من الكاش (بدون نسخ)، والناقص يتحمل في طلب واحد"""
+    cache = get_df_cache()
+    found = {n: cache.get(n) for n in ws_names}
+    missing = [n for n, df in found.items() if df is None]
+    if missing:
+        storage, snapshots = get_storage(), get_snapshot_store()
+        found.update(get_single_flight().fetch(
+            missing, lambda names: _refresh(cache, storage, names, snapshots)
+        ))
+    return found
+
+def get_dfs(*ws_names):
+    """جلب كذا جدول: الموجود في الكاش من الكاش، والباقي في طلب واحد"""
+    found = _shared_dfs(ws_names)
+    # نسخة لكل جلسة لأن الصفحات بتعدل على الأعمدة
+    return [found[n].copy() if found[n] is not None else pd.DataFrame() for n in ws_names]
+
+def derived_df(ws_name, name, fn):
+    """
+    نتيجة fn على النسخة المشتركة من الجدول بدون نسخه، محسوبة مرة لكل تحميل
+    (fn لازم ماتعدلش على الجدول).
+    """
+    df = _shared_dfs([ws_name]).get(ws_name)
+    if df is None: return fn(pd.DataFrame())
+    val = get_df_cache().derive(ws_name, name, fn)
+    return fn(df) if val is None else val
+
+def _delta_refresh(cache, storage, ws_name):
+    """تحديث جدول إضافة-فقط بالصفوف الجديدة بس؛ None = لازم تحميل كامل"""
+    old = cache.peek(ws_name)
+    if old is None or old.empty: return None
     try:
-        sheet = client.open(SHEET_NAME)
-        ws = sheet.worksheet(ws_name)
-        return pd.DataFrame(ws.get_all_records())
+        new = storage.read_delta(ws_name, old)
     except:
-        return pd.DataFrame()
+        return None
+    if new is None: return None
+    df = pd.concat([old, new], ignore_index=True) if len(new) else old
+    cache.put(ws_name, df)
+    return df
+
+def get_df(ws_name):
+    """جلب البيانات كـ DataFrame (من الكاش المشترك لو متاح)"""
+    # نسخة لكل جلسة لأن الصفحات بتعدل على الأعمدة
+    return get_dfs(ws_name)[0]
+
+# --- اللقطة المحلية والتشغيل السريع (Snapshot / Warm Start) ---
+
+class SnapshotStore:
+    """لقطة محلية بصيغة Feather من آخر بيانات متزامنة + بيانات المزامنة (meta.json)"""
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.meta_path = os.path.join(path, "meta.json")
+        self._saved = {}
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return feather is not None
+
+    def _file(self, ws_name):
+        return os.path.join(self.path, f"{ws_name}.feather")
+
+    def read_meta(self):
+        try:
+            with open(self.meta_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def maybe_save(self, ws_name, df, force=False):
+        """حفظ اللقطة (مرة كل interval على الأكثر لكل جدول)"""
+        if not self.enabled or df.empty: return
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._saved.get(ws_name, float("-inf")) < self.interval: return
+            self._saved[ws_name] = now
+            # كل الأعمدة نصوص: أعمدة الشيت ممكن تبقى خليط أرقام ونصوص
+            table = pa.Table.from_pandas(df.astype(object).where(df.notna(), "").astype(str), preserve_index=False)
+            tmp = self._file(ws_name) + ".tmp"
+            feather.write_feather(table, tmp)
+            os.replace(tmp, self._file(ws_name))
+            meta = self.read_meta()
+            meta[ws_name] = {"rows": len(df), "saved_at": str(datetime.now()), "schema": SCHEMA_VERSION}
+            with open(self.meta_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(self.meta_path + ".tmp", self.meta_path)
+
+    def load(self):
+        """اللقطات المطابقة لبصمة الهيكل الحالية فقط (قراءة memory-mapped)"""
+        if not self.enabled: return {}
+        frames = {}
+        for ws_name, meta in self.read_meta().items():
+            if ws_name not in SCHEMA_MAP or meta.get("schema") != SCHEMA_VERSION: continue
+            try:
+                frames[ws_name] = feather.read_table(self._file(ws_name), memory_map=True).to_pandas()
+            except Exception:
+                continue
+        return frames
+
+
+@st.cache_resource
+def get_snapshot_store():
+    return SnapshotStore(os.path.join(DATA_DIR, "snapshots"), SNAPSHOT_INTERVAL)
+
+def _revalidate(cache, snapshots, ws_names):
+    """التحقق من الهيكل والبيانات الحقيقية في الخلفية بعد التشغيل من اللقطة"""
+    storage = get_storage()
+    if storage is None: return
+    try:
+        if storage.ensure_schema(): mark_schema_dirty()
+    except Exception:
+        mark_schema_dirty()
+    _refresh(cache, storage, ws_names, snapshots, force_save=True)
+
+@st.cache_resource
+def warm_start():
+    """
+    أول تشغيل للعملية: اللقطة تدخل الكاش فوراً (أول صفحة بدون أي طلب لجوجل)
+    والتحقق من البيانات والهيكل بيحصل في الخلفية. يرجع True لو اللقطة اتحملت.
+    """
+    snapshots = get_snapshot_store()
+    frames = snapshots.load()
+    if not frames: return False
+    cache = get_df_cache()
+    for ws_name, df in frames.items():
+        cache.put(ws_name, _compact(ws_name, df))
+    if all(n in frames for n in SCHEMA_MAP):
+        # اللقطة اتحفظت بعد فحص نفس بصمة الهيكل، والفحص الفعلي في الخلفية
+        state = get_schema_state()
+        state.version = SCHEMA_VERSION
+        state.checked_at = "snapshot"
+    threading.Thread(
+        target=_revalidate, args=(cache, snapshots, list(frames)), name="snapshot-revalidate", daemon=True
+    ).start()
+    return True
+
+def _process_started_at():
+    """وقت بدء العملية من /proc (لينكس)، وNone لو مش متاح"""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + start_ticks / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return None
+
+@st.cache_resource
+def get_startup_clock():
+    return {"started": _process_started_at() or time.time(), "first_render": None, "warm": False}
+
+def record_first_render():
+    """قياس الزمن من بدء العملية حتى أول عرض لصفحة الدخول (مرة واحدة لكل عملية)"""
+    clock = get_startup_clock()
+    if clock["first_render"] is not None: return
+    clock["first_render"] = time.time() - clock["started"]
+    rec = {"ts": str(datetime.now()), "first_render_s": round(clock["first_render"], 3),
+           "warm": clock["warm"], "backend": STORAGE_BACKEND}
+    logger.info("startup: %s", json.dumps(rec))
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        with open(os.path.join(DATA_DIR, "startup.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(rec) + "\n")
+    except OSError:
+        pass
+
+# --- فهرس الدخول (Credential Index) ---
+
+class CredentialIndex:
+    """
+    فهرس دخول مشترك: الكود المنظف -> (كلمة المرور، tuple بحقول البوابة).
+    الجلسة بتحفظ الكود بس، والسجل بيتقري من هنا وقت العرض.
+    """
+
+    def __init__(self, role):
+        self.role = role
+        self.fields = PORTAL_FIELDS[role]
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.built_at = None
+
+    def stale(self, max_age):
+        return self.built_at is None or time.monotonic() - self.built_at > max_age
+
+    def rebuild(self, df):
+        """إعادة البناء من الجدول؛ لو التحميل فشل (جدول فاضي) الفهرس القديم بيفضل زي ما هو"""
+        if df.empty or "Code" not in df.columns: return False
+        codes = df['Code'].astype(str).str.strip()
+        pwds = df['Password'].astype(str).str.strip()
+        records = df.reindex(columns=self.fields).astype(object).fillna("").itertuples(index=False, name=None)
+        entries = dict(zip(codes, zip(pwds, records)))
+        with self._lock:
+            self._entries = entries
+            self.built_at = time.monotonic()
+        return True
+
+    def add(self, data):
+        """تحديث تدريجي عند تسجيل مستخدم جديد"""
+        rec = tuple(data.get(f, "") for f in self.fields)
+        with self._lock:
+            self._entries[str(data['Code']).strip()] = (str(data['Password']).strip(), rec)
+
+    def __contains__(self, code):
+        return str(code).strip() in self._entries
+
+    def lookup(self, code, pwd):
+        entry = self._entries.get(str(code).strip())
+        if entry and entry[0] == str(pwd).strip():
+            return dict(zip(self.fields, entry[1]))
+        return None
+
+    def record(self, code):
+        """سجل البوابة بالكود (بدون كلمة المرور)"""
+        entry = self._entries.get(str(code).strip())
+        return dict(zip(self.fields, entry[1])) if entry else None
+
+
+@st.cache_resource
+def get_credential_index(role):
+    return CredentialIndex(role)
+
+def _fresh_index(role, code):
+    """الفهرس يتبني فقط لما يكون قديم، أو لما الكود مش موجود (ممكن يكون اتسجل من عملية تانية)"""
+    idx = get_credential_index(role)
+    if idx.stale(LOGIN_INDEX_MAX_AGE):
+        idx.rebuild(get_df(ROLE_SHEETS[role]))
+    elif code not in idx and idx.stale(DF_CACHE_TTL):
+        invalidate_df(ROLE_SHEETS[role])
+        idx.rebuild(get_df(ROLE_SHEETS[role]))
+    return idx
+
+def check_login(role, code, pwd):
+    """التحقق من الدخول من الفهرس (O(1))"""
+    return _fresh_index(role, code).lookup(code, pwd)
+
+def current_user():
+    """سجل المستخدم الحالي من الفهرس المشترك (الجلسة فيها الكود بس)، وNone لو اتمسح"""
+    role, code = st.session_state.get('role'), st.session_state.get('user_code')
+    if role not in ROLE_SHEETS or not code: return None
+    return _fresh_index(role, code).record(code)
+
+def roster_row(df, code):
+    """صف واحد من الجدول المشترك بالكود (الكود متنظف في compact_roster)"""
+    if df.empty: return None
+    hit = np.flatnonzero(df["Code"].to_numpy() == str(code).strip())
+    return df.iloc[hit[0]] if len(hit) else None
+
+def logout():
+    for key in ('user_code', 'fin_code'):
+        st.session_state.pop(key, None)
+    st.session_state['role'] = None
+
+# --- البحث عن الطلاب (Search Index) ---
+
+_AR_DIACRITICS = re.compile("[\u064B-\u0652\u0670\u0640]")  # تشكيل + تطويل
+_AR_FOLD = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ى": "ي", "ئ": "ي", "ؤ": "و", "ة": "ه",
+    **{chr(0x0660 + i): str(i) for i in range(10)},  # أرقام عربية
+    **{chr(0x06F0 + i): str(i) for i in range(10)},  # أرقام فارسية
+})
+
+def normalize_ar(text):
+    """توحيد الكتابة العربية للبحث: حذف التشكيل وتوحيد الألف والياء والتاء المربوطة والأرقام"""
+    text = _AR_DIACRITICS.sub("", str(text)).translate(_AR_FOLD).lower()
+    return " ".join(text.split())
+
+SEARCH_FIELDS = ["Code", "Name", "National_ID", "Phone", "Seat_Num"]
+
+
+class StudentSearchIndex:
+    """
+    فهرس بحث بالبادئة (prefix) على كلمات الاسم والكود والرقم القومي والهاتف ورقم الجلوس:
+    قائمة مرتبة من (كلمة، رقم الطالب) والبحث فيها بالـ bisect.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs = []  # (بيانات العرض، كلمات البحث)
+        self._keys = []  # مرتبة: (كلمة منظمة، رقم الطالب)
+        self._refreshing = False
+        self.built_at = None
+
+    def stale(self, max_age):
+        return self.built_at is None or time.monotonic() - self.built_at > max_age
+
+    @staticmethod
+    def _words(rec):
+        words = normalize_ar(rec.get("Name", "")).split()
+        for f in ("Code", "National_ID", "Phone", "Seat_Num"):
+            v = normalize_ar(rec.get(f, ""))
+            if v: words.append(v)
+        return tuple(dict.fromkeys(words))
+
+    def rebuild(self, df):
+        """إعادة البناء؛ لو التحميل فشل (جدول فاضي) الفهرس القديم بيفضل زي ما هو"""
+        if df.empty: return False
+        docs, keys = [], []
+        recs = df.reindex(columns=SEARCH_FIELDS).fillna("").astype(str).to_dict("records")
+        for doc_id, rec in enumerate(recs):
+            words = self._words(rec)
+            docs.append((rec, words))
+            keys.extend((w, doc_id) for w in words)
+        keys.sort()
+        with self._lock:
+            self._docs, self._keys = docs, keys
+            self.built_at = time.monotonic()
+        return True
+
+    def refresh_async(self, load):
+        """إعادة البناء في الخلفية والبحث شغال على الفهرس الحالي (خيط واحد بس في نفس الوقت)"""
+        with self._lock:
+            if self._refreshing: return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.rebuild(load())
+            except Exception:
+                pass
+            finally:
+                self._refreshing = False
+        threading.Thread(target=run, name="search-rebuild", daemon=True).start()
+
+    def add(self, rec):
+        """إضافة طالب جديد بدون إعادة بناء"""
+        rec = {f: str(rec.get(f, "")) for f in SEARCH_FIELDS}
+        words = self._words(rec)
+        with self._lock:
+            doc_id = len(self._docs)
+            self._docs.append((rec, words))
+            for w in words:
+                bisect.insort(self._keys, (w, doc_id))
+
+    def _range(self, prefix):
+        lo = bisect.bisect_left(self._keys, (prefix,))
+        hi = bisect.bisect_left(self._keys, (prefix + "\uffff",))
+        return lo, hi
+
+    def search(self, query, limit=20):
+        tokens = normalize_ar(query).split()
+        if not tokens: return []
+        with self._lock:
+            # نمشي على أضيق مدى، ونتأكد من باقي الكلمات في بيانات الطالب نفسه
+            ranges = sorted(((self._range(t), t) for t in tokens), key=lambda r: r[0][1] - r[0][0])
+            lo, hi = ranges[0][0]
+            rest = [t for _, t in ranges[1:]]
+            out, seen = [], set()
+            for i in range(lo, hi):
+                doc_id = self._keys[i][1]
+                if doc_id in seen: continue
+                seen.add(doc_id)
+                rec, words = self._docs[doc_id]
+                if all(any(w.startswith(t) for w in words) for t in rest):
+                    out.append(dict(rec))
+                    if len(out) >= limit: break
+            return out
+
+
+@st.cache_resource
+def get_search_index():
+    return StudentSearchIndex()
+
+def search_students(query, limit=20):
+    """بحث سريع (type-ahead) في الطلاب بالاسم أو الكود أو الرقم القومي أو الهاتف أو رقم الجلوس"""
+    idx = get_search_index()
+    if idx.built_at is None:
+        idx.rebuild(get_df("Students_Main"))
+    elif idx.stale(LOGIN_INDEX_MAX_AGE):
+        # الكاشير مايستناش إعادة البناء (ثواني مع 100 ألف طالب)
+        idx.refresh_async(lambda: get_df("Students_Main"))
+    return idx.search(query, limit)
 
 # ---------------------------------------------------------
 # 3. المنطق (Business Logic)
 # ---------------------------------------------------------
 
+def _ledger_index(led):
+    """كود -> مواقع قيوده في الدفتر المشترك (بيتبني مرة لكل نسخة من الدفتر في الكاش)"""
+    if led.empty: return led, {}
+    codes = led["Code"].astype(str).str.strip()
+    return led, codes.groupby(codes, sort=False).indices
+
+def ledger_rows(code):
+    """قيود طالب واحد من الدفتر بكل الأعمدة"""
+    storage = get_storage()
+    if storage.indexed:
+        return storage.read_ledger(code)
+    # Sheets: فهرس بالكود على الدفتر المشترك بدل نسخه ومسحه كله في كل عرض
+    led, index = derived_df("Ledger", "by_code", _ledger_index)
+    pos = index.get(str(code).strip())
+    return led.iloc[0:0] if pos is None else led.take(pos)
+
+def get_ledger(code):
+    """سجل الطالب (الأكاديمي والمالي) بعناوين العرض العربية"""
+    df = ledger_rows(code)
+    return df.reindex(columns=list(LEDGER_VIEW)).rename(columns=LEDGER_VIEW).reset_index(drop=True)
+
+def ledger_money(ledger):
+    """
+    مجاميع الدفتر لكل كود من القيود اللي ليها Ref بس (قيود الإضافة ذرية، فمفيش دفعتين بيكتبوا فوق بعض):
+    قيود payment في Paid_* وقيود charge (مستحقات سنين سابقة) في Carried_*. الناتج بأعمدة LEDGER_MONEY.
+    """
+    empty = pd.DataFrame(columns=LEDGER_MONEY, dtype="int64")
+    if ledger.empty or "Ref" not in ledger.columns: return empty
+    kind = ledger["Kind"].astype(str)
+    field = ledger["Item"].map(PAY_ITEMS).where(kind == "payment", ledger["Item"].map(CARRY_ITEMS).where(kind == "charge"))
+    led = ledger[(ledger["Ref"].astype(str).str.strip() != "") & field.notna()]
+    if led.empty: return empty
+    amount = pd.to_numeric(led["Value"].astype(str).str.extract(r"(\d+)", expand=False), errors="coerce").fillna(0)
+    out = amount.groupby([led["Code"].astype(str).str.strip(), field[led.index]]).sum().unstack(fill_value=0)
+    return out.reindex(columns=LEDGER_MONEY, fill_value=0).astype("int64")
+
+def student_balance(row):
+    """
+    أرصدة طالب واحد: المدفوع = رصيد الخلية (قبل الدفتر) + قيود الدفع،
+    والمرحل = مستحقات السنين اللي خلصت من قيود charge.
+    """
+    code = str(row["Code"]).strip()
+    net = ledger_money(ledger_rows(code))
+    out = {f: (int(net.at[code, f]) if code in net.index else 0) for f in LEDGER_MONEY}
+    for f in ROSTER_MONEY: out[f] += safe_num(row[f])
+    return out
+
 def gen_code(role):
     # كود مميز لا يتكرر بسهولة
     nums = ''.join(random.choices(string.digits, k=7))
@@ -160,6 +1652,48 @@ def gen_code(role):
         prefix = random.choice(string.ascii_uppercase)
         return f"{prefix}{nums}"
 
+class CodeAllocator:
+    """
+    توزيع أكواد بدون تكرار وبدون أي قراءة من جوجل وقت التسجيل:
+    مجموعة (set) بالأكواد المصدرة في الذاكرة + جدول حجز محلي (PRIMARY KEY)
+    يمنع التكرار بين الجلسات والعمليات اللي شغالة على نفس السيرفر.
+    """
+
+    def __init__(self, path, seed_codes):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "issued" ("code" TEXT PRIMARY KEY)')
+        seed = [(c,) for c in (str(x).strip() for x in seed_codes) if c and c != "Code"]
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO "issued" VALUES (?)', seed)
+        self._issued = {r[0] for r in self.conn.execute('SELECT "code" FROM "issued"')}
+
+    def allocate(self, role, n=1):
+        """حجز n كود جديد في معاملة واحدة"""
+        out = []
+        with self._lock, self.conn:
+            while len(out) < n:
+                code = gen_code(role)
+                if code in self._issued: continue
+                cur = self.conn.execute('INSERT OR IGNORE INTO "issued" VALUES (?)', (code,))
+                self._issued.add(code)
+                # rowcount = 0 يعني عملية تانية حجزته قبلنا
+                if cur.rowcount == 1: out.append(code)
+        return out
+
+
+@st.cache_resource
+def get_code_allocator():
+    """المجموعة تتملى مرة واحدة لكل عملية من الجداول الرئيسية"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    storage = get_storage()
+    seed = []
+    for ws_name in ROLE_SHEETS.values():
+        try: seed += storage.codes(ws_name)
+        except: pass
+    return CodeAllocator(os.path.join(DATA_DIR, "codes.db"), seed)
+
 def calc_fees(year):
     fees = BASE_TUITION
     try: y = int(year)
@@ -168,9 +1702,112 @@ def calc_fees(year):
         fees += fees * 0.10 # زيادة 10%
     return int(fees)
 
+def _money(col):
+    """نفس منطق safe_num لعمود كامل مرة واحدة"""
+    s = col.astype(str).str.replace(",", "", regex=False)
+    return pd.to_numeric(s.where(s.str.isdigit(), "0")).astype("int64")
+
+def finance_report(df, paid=None):
+    """
+    المستحق والمرحل والمدفوع والمتبقي (مصاريف + كتب) لكل الطلاب في عملية واحدة بدون loop لكل طالب.
+    paid = ناتج ledger_money (قيود الدفع بتتضاف على رصيد الخلايا، وقيود charge في أعمدة Carried_*).
+    """
+    cols = ["Code", "Name", "Year", "Major", "Governorate"]
+    if df.empty: return pd.DataFrame(columns=cols)
+    rep = df.reindex(columns=cols).copy()
+    year = pd.to_numeric(df["Year"].astype(str), errors="coerce").fillna(1).astype("int64")
+    rep["Year"] = year
+    # calc_fees لكل فرقة مختلفة مرة واحدة بس (عدد الفرق صغير) ثم توزيع بالـ map
+    fees = {y: calc_fees(y) for y in year.unique()}
+    rep["Due_Tuition"] = year.map(fees).astype("int64")
+    rep["Carried_Tuition"] = 0
+    rep["Paid_Tuition"] = _money(df["Paid_Tuition"])
+    rep["Due_Books"] = year.map(BOOK_FEES_MAP).fillna(2000).astype("int64")
+    rep["Carried_Books"] = 0
+    rep["Paid_Books"] = _money(df["Paid_Books"])
+    if paid is not None and not paid.empty:
+        code = rep["Code"].astype(str).str.strip()
+        for col in LEDGER_MONEY:
+            rep[col] += code.map(paid[col]).fillna(0).astype("int64")
+    rep["Out_Tuition"] = rep["Due_Tuition"] + rep["Carried_Tuition"] - rep["Paid_Tuition"]
+    rep["Out_Books"] = rep["Due_Books"] + rep["Carried_Books"] - rep["Paid_Books"]
+    rep["Outstanding"] = rep["Out_Tuition"] + rep["Out_Books"]
+    paid = rep["Paid_Tuition"] + rep["Paid_Books"]
+    rep["Status"] = np.select(
+        [rep["Outstanding"] <= 0, paid > 0], ["مسدد", "سداد جزئي"], default="لم يسدد"
+    )
+    return rep
+
+def finance_summary(rep, by):
+    """تجميع التقرير حسب الفرقة / التخصص / المحافظة"""
+    money = ["Due_Tuition", "Carried_Tuition", "Paid_Tuition", "Out_Tuition",
+             "Due_Books", "Carried_Books", "Paid_Books", "Out_Books", "Outstanding"]
+    # observed=True: التخصص والمحافظة category، فبدونها هيطلع كل التوافيق الممكنة
+    out = rep.groupby(by, dropna=False, observed=True)[money].sum()
+    out.insert(0, "Students", rep.groupby(by, dropna=False, observed=True).size())
+    due = out["Due_Tuition"] + out["Carried_Tuition"] + out["Due_Books"] + out["Carried_Books"]
+    out["Collection_%"] = ((due - out["Outstanding"]) / due.where(due != 0) * 100).round(1)
+    return out.reset_index()
+
+def _roster_students(df_s):
+    """الكود والاسم والفرقة (رقم) لكل طالب، مرة لكل نسخة من Students_Main"""
+    if df_s.empty: return pd.DataFrame(columns=["Code", "Name", "Year"])
+    return pd.DataFrame({
+        "Code": df_s["Code"].astype(str).str.strip(),
+        "Name": df_s["Name"],
+        "Year": pd.to_numeric(df_s["Year"].astype(str), errors="coerce"),
+    })
+
+def _ledger_grades(led):
+    """قيود التقديرات بس من الدفتر، مرة لكل نسخة منه"""
+    if led.empty: return pd.DataFrame(columns=["Code", "Item", "Value"])
+    g = led[led["Kind"] == "grade"]
+    return pd.DataFrame({
+        "Code": g["Code"].astype(str).str.strip(),
+        "Item": g["Item"].astype(str),
+        "Value": g["Value"].astype(str),
+    })
+
+def class_roster(students, grades, year_level, subject):
+    """
+    طلاب الفرقة مع آخر تقدير مرصود لهم في المادة.
+    students/grades من _roster_students/_ledger_grades، بيتحملوا مرة في العرض ويتبعتوا لكل مادة.
+    """
+    if students.empty: return pd.DataFrame(columns=["Code", "Name", "Grade"])
+    roster = students.loc[students["Year"] == pd.to_numeric(year_level, errors="coerce"), ["Code", "Name"]].copy()
+    g = grades[grades["Item"] == f"نتيجة {subject}"]
+    # الدفتر بالترتيب، فآخر قيد لكل كود هو اللي بيفضل في الـ dict
+    prev = dict(zip(g["Code"], g["Value"]))
+    roster["Grade"] = roster["Code"].map(prev).fillna("")
+    return roster.reset_index(drop=True)
+
+def submit_grades(subject, roster, edited):
+    """
+    فحص كل صف في الجدول ورصد التقديرات المتغيرة فقط كدفعة واحدة على الدفتر.
+    يرجع (الجدول مع حالة كل صف، عدد التقديرات المرصودة).
+    """
+    out = edited.copy()
+    grade = out["Grade"].fillna("").astype(str).str.strip()
+    changed = grade != roster["Grade"]
+    valid = grade.isin(GRADE_OPTIONS)
+    out["الحالة"] = np.select(
+        [~changed, valid, grade == ""],
+        ["بدون تغيير", "تم الرصد", "لا يمكن مسح تقدير مرصود"],
+        default="تقدير غير صالح"
+    )
+    ok = out[changed & valid]
+    if not ok.empty:
+        now = str(datetime.now())
+        q = get_write_queue()
+        q.submit_many("append", [
+            {"ws": "Ledger", "row": [c, "grade", f"نتيجة {subject}", g, now, "", ""]}
+            for c, g in zip(ok["Code"], grade[ok.index])
+        ])
+        q.flush_now()
+    return out, len(ok)
+
 def register_user(role, data):
-    client = get_client()
-    sheet = client.open(SHEET_NAME)
+    storage = get_storage()
     
     if role == "Teacher":
         ws_name = "Teachers_Main"
@@ -178,18 +1815,10 @@ def register_user(role, data):
     else:
         ws_name = "Students_Main"
         headers = HEADERS_STUDENT
-        
-    ws = sheet.worksheet(ws_name)
-    
-    # التحقق من التكرار
-    try: existing = ws.col_values(1)
-    except: existing = []
     
-    while True:
-        code = gen_code(role)
-        if code not in existing: break
-            
-    pwd = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
+    # كود محجوز بدون تكرار
+    code = get_code_allocator().allocate(role)[0]
+    pwd = _gen_password()
     
     # إضافة البيانات المولدة
     data['Code'] = code
@@ -202,19 +1831,75 @@ def register_user(role, data):
         
     # ترتيب البيانات حسب الهيدر
     row = [data.get(h, "") for h in headers]
-    ws.append_row(row)
-    
-    # إنشاء الشيت الخاص
-    try:
-        try: sheet.worksheet(code)
-        except:
-            ws_p = sheet.add_worksheet(code, 100, 10)
-            ws_p.append_row(["البيان", "القيمة/الحالة", "التاريخ", "Link"])
-            ws_p.append_row(["تنبيه", "هذا السجل رسمي", str(datetime.now()), ""])
-    except: pass
+    with schema_guard():
+        storage.append(ws_name, row)
+    invalidate_df(ws_name)
+    get_credential_index(role).add(data)
+    if role == "Student": get_search_index().add(data)
     
     return code, pwd
 
+def _gen_password():
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=8))
+
+def bulk_register_students(df_in):
+    """
+    تسجيل دفعة طلاب من ملف (CSV/Excel) بأعمدة HEADERS_STUDENT:
+    فحص كامل بالـ pandas مرة واحدة، ثم أكواد وكلمات مرور للكل وكتابة واحدة (append_rows).
+    يرجع (بيانات الدخول للمسجلين، الصفوف المرفوضة مع السبب).
+    """
+    storage = get_storage()
+    df = df_in.copy()
+    df.columns = [str(c).strip() for c in df.columns]
+    df = df.reindex(columns=HEADERS_STUDENT).fillna("").astype(str)
+    for col in HEADERS_STUDENT:
+        df[col] = df[col].str.strip()
+    # إكسل أحياناً بيحول الرقم القومي لـ float
+    nid = df["National_ID"].str.replace(r"\.0$", "", regex=True)
+    df["National_ID"] = nid
+
+    roster = get_df("Students_Main")
+    known = set()
+    if not roster.empty:
+        known = set(roster["National_ID"].astype(str).str.strip())
+
+    errors = pd.Series("", index=df.index)
+    checks = [
+        (df["Name"] == "", "الاسم فارغ"),
+        (~nid.str.fullmatch(r"\d{14}"), "الرقم القومي لازم 14 رقم"),
+        (nid.duplicated(keep=False) & (nid != ""), "الرقم القومي مكرر في الملف"),
+        (nid.isin(known), "الرقم القومي مسجل بالفعل"),
+    ]
+    for mask, msg in checks:
+        errors[mask] = errors[mask] + msg + " | "
+    bad = errors != ""
+    rejected = df_in.loc[bad].copy()
+    rejected["سبب الرفض"] = errors[bad].str.rstrip(" |").values
+    ok = df.loc[~bad].copy()
+    if ok.empty:
+        return pd.DataFrame(columns=["Code", "Name", "National_ID", "Password"]), rejected
+
+    # أكواد وكلمات مرور للدفعة كلها
+    ok["Code"] = get_code_allocator().allocate("Student", len(ok))
+    ok["Password"] = [_gen_password() for _ in range(len(ok))]
+    ok["Join_Date"] = str(datetime.now())
+    ok["Year"] = 1
+    ok["Paid_Tuition"] = 0
+    ok["Paid_Books"] = 0
+    ok.loc[ok["Nationality"] == "", "Nationality"] = "مصر"
+    ok.loc[ok["Religion"] == "", "Religion"] = "غير محدد"
+
+    with schema_guard():
+        storage.append_rows("Students_Main", ok[HEADERS_STUDENT].values.tolist())
+    invalidate_df("Students_Main")
+    idx = get_credential_index("Student")
+    search = get_search_index()
+    for rec in ok.to_dict("records"):
+        idx.add(rec)
+        search.add(rec)
+
+    return ok[["Code", "Name", "National_ID", "Password"]].reset_index(drop=True), rejected
+
 # ---------------------------------------------------------
 # 4. بوابات النظام (Portals)
 # ---------------------------------------------------------
@@ -224,8 +1909,7 @@ def admin_dashboard():
     st.markdown("---")
     
     # إحصائيات سريعة
-    df_s = get_df("Students_Main")
-    df_t = get_df("Teachers_Main")
+    df_s, df_t = get_dfs("Students_Main", "Teachers_Main")
     
     m1, m2, m3, m4 = st.columns(4)
     m1.metric("إجمالي الطلاب", len(df_s))
@@ -233,10 +1917,33 @@ def admin_dashboard():
     m3.metric("تاريخ اليوم", str(datetime.now().date()))
     m4.metric("حالة النظام", "نشط ✅")
     
+    with st.expander("⚙️ صيانة النظام"):
+        state = get_schema_state()
+        st.caption(f"بصمة الهيكل: {SCHEMA_VERSION} | آخر فحص: {state.checked_at or '—'}")
+        clock = get_startup_clock()
+        if clock["first_render"] is not None:
+            mode = "من اللقطة المحلية" if clock["warm"] else "تشغيل بارد"
+            st.caption(f"زمن أول عرض بعد التشغيل: {clock['first_render']:.2f} ث ({mode})")
+        if st.button("🔄 إعادة فحص هيكل البيانات"):
+            with st.spinner("جاري الفحص..."):
+                ok = ensure_schema(force=True)
+            if ok: st.success("تم فحص وإصلاح الهيكل")
+        if st.button("⬆️ رفع العمليات المعلقة الآن"):
+            get_write_queue().flush_now()
+        st.caption("ترحيل السجلات الفردية القديمة (شيت لكل طالب) إلى الدفتر الموحد")
+        del_old = st.checkbox("حذف الشيتات القديمة بعد الترحيل")
+        if st.button("🗂️ ترحيل إلى الدفتر الموحد"):
+            with st.spinner("جاري الترحيل..."):
+                with api_priority("bulk"):
+                    n = get_storage().migrate_to_ledger(delete_old=del_old)
+            invalidate_df("Ledger")
+            st.success(f"تم ترحيل {n} قيد")
+    
     st.markdown("---")
     
-    tab_reg_s, tab_reg_t, tab_fin, tab_acd = st.tabs([
-        "👤 تسجيل طلاب", "👨‍🏫 تسجيل معلمين", "💰 الخزينة", "📚 الشؤون الأكاديمية"
+    tab_reg_s, tab_bulk, tab_reg_t, tab_fin, tab_rep, tab_acd, tab_diag = st.tabs([
+        "👤 تسجيل طلاب", "📥 استيراد جماعي", "👨‍🏫 تسجيل معلمين", "💰 الخزينة",
+        "📊 التقارير المالية", "📚 الشؤون الأكاديمية", "🩺 التشخيص"
     ])
     
     # --- 1. تسجيل الطلاب ---
@@ -280,6 +1987,40 @@ def admin_dashboard():
                 st.success("✅ تم التسجيل بنجاح")
                 st.info(f"الكود: {c} | الباسوورد: {p}")
 
+    # --- 1.1 الاستيراد الجماعي ---
+    with tab_bulk:
+        st.subheader("استيراد دفعة طلاب من ملف")
+        st.caption("ملف CSV أو Excel بنفس عناوين جدول الطلاب (الاسم والرقم القومي إلزاميين)")
+        st.download_button(
+            "⬇️ تحميل قالب فارغ",
+            pd.DataFrame(columns=HEADERS_STUDENT).to_csv(index=False).encode("utf-8-sig"),
+            "students_template.csv", "text/csv"
+        )
+        up = st.file_uploader("ملف الطلاب", type=["csv", "xlsx"], key="bulk_file")
+        if up is not None:
+            if up.name.endswith(".xlsx"): df_in = pd.read_excel(up, dtype=str)
+            else: df_in = pd.read_csv(up, dtype=str)
+            st.caption(f"عدد الصفوف في الملف: {len(df_in):,}")
+            st.dataframe(df_in.head(20), use_container_width=True)
+            if st.button("🚀 استيراد وتسجيل الكل"):
+                with st.spinner("جاري الفحص والتسجيل..."):
+                    with api_priority("bulk"):
+                        created, rejected = bulk_register_students(df_in)
+                st.session_state['bulk_result'] = (created, rejected)
+
+        if 'bulk_result' in st.session_state:
+            created, rejected = st.session_state['bulk_result']
+            st.success(f"✅ تم تسجيل {len(created):,} طالب")
+            if not created.empty:
+                st.download_button(
+                    "⬇️ تحميل بيانات الدخول",
+                    created.to_csv(index=False).encode("utf-8-sig"),
+                    "credentials.csv", "text/csv"
+                )
+            if not rejected.empty:
+                st.error(f"تم رفض {len(rejected):,} صف")
+                st.dataframe(rejected, use_container_width=True)
+
     # --- 2. تسجيل المعلمين ---
     with tab_reg_t:
         st.subheader("إضافة عضو هيئة تدريس")
@@ -306,18 +2047,21 @@ def admin_dashboard():
     # --- 3. الخزينة ---
     with tab_fin:
         st.subheader("نظام التحصيل المالي الذكي")
-        search = st.text_input("بحث بكود الطالب", key="fin_search")
-        if st.button("بحث") or 'fin_user' in st.session_state:
-            if search:
-                if not df_s.empty:
-                    df_s['Code'] = df_s['Code'].astype(str).str.strip()
-                    res = df_s[df_s['Code'] == str(search).strip()]
-                    if not res.empty:
-                        st.session_state['fin_user'] = res.iloc[0].to_dict()
+        search = st.text_input("بحث بالاسم / الكود / الرقم القومي / الهاتف / رقم الجلوس", key="fin_search")
+        if search:
+            hits = search_students(search)
+            if hits:
+                labels = [f"{h['Name']} | {h['Code']} | {h['National_ID']}" for h in hits]
+                pick = st.selectbox("النتائج", range(len(hits)), format_func=lambda i: labels[i], key="fin_pick")
+                if st.button("اختيار الطالب"):
+                    if roster_row(df_s, hits[pick]['Code']) is not None:
+                        st.session_state['fin_code'] = hits[pick]['Code'].strip()
                     else: st.error("غير موجود")
+            else: st.error("غير موجود")
 
-        if 'fin_user' in st.session_state:
-            u = st.session_state['fin_user']
+        # الجلسة فيها الكود بس، والصف من الجدول المشترك
+        u = roster_row(df_s, st.session_state['fin_code']) if 'fin_code' in st.session_state else None
+        if u is not None:
             st.markdown(f"**الطالب:** {u['Name']} | **الفرقة:** {u['Year']}")
             
             try: yr = int(u['Year'])
@@ -326,9 +2070,11 @@ def admin_dashboard():
             t_total = calc_fees(yr)
             b_total = BOOK_FEES_MAP.get(yr, 2000)
             
-            def safe_num(v): return int(str(v).replace(',','')) if str(v).replace(',','').isdigit() else 0
-            paid_t = safe_num(u['Paid_Tuition'])
-            paid_b = safe_num(u['Paid_Books'])
+            bal = student_balance(u)
+            # المتبقي = مستحق السنة + المرحل من السنين اللي فاتت - المدفوع
+            t_total += bal["Carried_Tuition"]
+            b_total += bal["Carried_Books"]
+            paid_t, paid_b = bal["Paid_Tuition"], bal["Paid_Books"]
             
             fc1, fc2 = st.columns(2)
             with fc1:
@@ -351,25 +2097,43 @@ def admin_dashboard():
             
             if st.button("إتمام عملية الدفع"):
                 if amt > 0:
-                    client = get_client()
-                    sheet = client.open(SHEET_NAME)
-                    ws = sheet.worksheet("Students_Main")
-                    cell = ws.find(str(u['Code']))
-                    
-                    # تحديث الرصيد (العمود 5 مصاريف، 6 كتب)
-                    col = 5 if pay_for == "المصاريف" else 6
-                    current = paid_t if pay_for == "المصاريف" else paid_b
-                    ws.update_cell(cell.row, col, current + amt)
+                    # الإيصال في الدفتر هو الدفع نفسه: الرصيد بيتحسب من قيود الدفع (ledger_money)
+                    get_write_queue().submit(
+                        "payment", ws="Ledger",
+                        row=[str(u['Code']), "payment", pay_for, f"{int(amt)} EGP", str(datetime.now()), note_extra]
+                    )
                     
-                    # إيصال
-                    try: sheet.worksheet(u['Code']).append_row([pay_for, f"{amt} EGP", str(datetime.now()), note_extra])
-                    except: pass
-                    
-                    st.success("تم الدفع بنجاح!")
-                    del st.session_state['fin_user']
+                    st.success("تم الدفع بنجاح! ⏳ جاري الرفع في الخلفية")
+                    del st.session_state['fin_code']
                     time.sleep(1)
                     st.rerun()
 
+    # --- 3.1 التقارير المالية ---
+    with tab_rep:
+        st.subheader("تقرير المديونيات لكل الطلاب")
+        rep = finance_report(df_s, derived_df("Ledger", "money", ledger_money))
+        if rep.empty: st.info("لا يوجد طلاب.")
+        else:
+            r1, r2, r3 = st.columns(3)
+            due = rep['Due_Tuition'] + rep['Carried_Tuition'] + rep['Due_Books'] + rep['Carried_Books']
+            r1.metric("إجمالي المستحق", f"{int(due.sum()):,}")
+            r2.metric("إجمالي المحصل", f"{int((rep['Paid_Tuition'] + rep['Paid_Books']).sum()):,}")
+            r3.metric("إجمالي المتبقي", f"{int(rep['Outstanding'].sum()):,}")
+
+            by_opts = {"الفرقة": "Year", "التخصص": "Major", "المحافظة": "Governorate"}
+            by = st.multiselect("التجميع حسب", list(by_opts), default=["الفرقة"], key="rep_by")
+            if by:
+                summary = finance_summary(rep, [by_opts[b] for b in by])
+                st.dataframe(summary, use_container_width=True)
+                st.download_button(
+                    "⬇️ تحميل الملخص", summary.to_csv(index=False).encode("utf-8-sig"),
+                    "finance_summary.csv", "text/csv"
+                )
+            st.download_button(
+                "⬇️ تحميل التفاصيل لكل طالب", rep.to_csv(index=False).encode("utf-8-sig"),
+                "finance_detail.csv", "text/csv"
+            )
+
     # --- 4. المواد ---
     with tab_acd:
         st.subheader("توزيع الخطة الدراسية")
@@ -382,15 +2146,70 @@ def admin_dashboard():
             term = c3.selectbox("الترم", ["الأول", "الثاني"])
             
             if st.button("إضافة المادة للجدول"):
-                client = get_client()
-                sheet = client.open(SHEET_NAME)
                 tc = sel_t.split(" (")[1][:-1]
                 tn = sel_t.split(" (")[0]
-                sheet.worksheet("Subjects_Data").append_row([sub_n, tc, tn, y_l, term])
-                st.success("تم الإسناد")
+                get_write_queue().submit("append", ws="Subjects_Data", row=[sub_n, tc, tn, y_l, term])
+                st.success("تم الإسناد ⏳ جاري الرفع في الخلفية")
+
+        if STORAGE_BACKEND == "sqlite":
+            st.markdown("---")
+            st.caption("القاعدة المحلية هي الأساس، وجوجل شيت نسخة مزامنة اختيارية")
+            if st.button("☁️ مزامنة مع Google Sheets"):
+                with st.spinner("جاري المزامنة..."):
+                    with api_priority("bulk"):
+                        ok = sync_to_sheets()
+                if ok: st.success("تمت المزامنة")
+                else: st.error("تعذر الاتصال بجوجل شيت")
+
+    # --- 5. التشخيص ---
+    with tab_diag:
+        st.subheader("استهلاك طلبات Google API")
+        monitor = get_api_monitor()
+        sched = get_api_scheduler().status()
+        st.caption(
+            f"منظم الحصة: {sched['tokens']} / {API_QUOTA_PER_MIN} طلب متاح | "
+            f"في الانتظار: {sched['waiting']} | زمن الانتظار (ث): {sched['waited_s']}"
+        )
+        calls = pd.DataFrame(monitor.calls())
+        if calls.empty: st.info("لا توجد طلبات مسجلة بعد.")
+        else:
+            d1, d2, d3 = st.columns(3)
+            d1.metric("عدد الطلبات", f"{len(calls):,}")
+            d2.metric("متوسط الزمن (ms)", f"{calls['latency_ms'].mean():.0f}")
+            d3.metric("أخطاء", int(calls['error'].notna().sum()))
+
+            st.caption("حسب البوابة")
+            st.dataframe(
+                calls.groupby("portal").agg(calls=("call", "size"), latency_ms=("latency_ms", "sum"), cells=("size", "sum")),
+                use_container_width=True
+            )
+            st.caption("حسب نوع الطلب والشيت")
+            st.dataframe(
+                calls.groupby(["call", "worksheet"], dropna=False)
+                     .agg(calls=("call", "size"), avg_ms=("latency_ms", "mean"), cells=("size", "sum"))
+                     .sort_values("calls", ascending=False),
+                use_container_width=True
+            )
+            per_rerun = (calls.dropna(subset=["rerun"]).groupby(["rerun", "portal"])
+                              .agg(calls=("call", "size"), latency_ms=("latency_ms", "sum")).reset_index())
+            over = per_rerun[per_rerun["calls"] > API_CALL_BUDGET]
+            st.caption(f"تحديثات تعدت الميزانية ({API_CALL_BUDGET} طلب): {len(over)}")
+            if not over.empty:
+                st.dataframe(over.sort_values("calls", ascending=False), hide_index=True, use_container_width=True)
+
+            e1, e2 = st.columns(2)
+            e1.download_button(
+                "⬇️ تصدير JSON Lines", monitor.to_jsonl().encode("utf-8"), "api_calls.jsonl", "application/jsonl"
+            )
+            if e2.button("🧹 مسح السجل"):
+                monitor.clear()
+                st.rerun()
 
 def teacher_portal():
-    u = st.session_state['user']
+    u = current_user()
+    if u is None:
+        logout()
+        st.rerun()
     st.markdown(f"## 👨‍🏫 بوابة المعلم: د/ {u['Name']}")
     
     df = get_df("Subjects_Data")
@@ -399,29 +2218,44 @@ def teacher_portal():
         my_subs = df[df['Teacher_Code'] == str(u['Code'])]
         
         if not my_subs.empty:
+            # الطلاب والتقديرات بيتحملوا مرة واحدة للعرض كله، مش مرة لكل مادة
+            students = derived_df("Students_Main", "roster", _roster_students)
+            grades = derived_df("Ledger", "grades", _ledger_grades)
             for i, r in my_subs.iterrows():
                 with st.expander(f"📘 {r['Subject_Name']} (فرقة {r['Year_Level']})"):
-                    col1, col2 = st.columns([3, 1])
-                    s_code = col1.text_input("كود الطالب", key=f"src{i}")
-                    res = col2.selectbox("التقدير", ["ناجح", "راسب", "امتياز", "جيد جداً"], key=f"res{i}")
-                    if st.button("رصد", key=f"btn{i}"):
-                        client = get_client()
-                        try:
-                            sheet = client.open(SHEET_NAME)
-                            ws = sheet.worksheet(s_code)
-                            ws.append_row([f"نتيجة {r['Subject_Name']}", res, str(datetime.now()), ""])
-                            st.success("تم الرصد")
-                        except:
-                            st.error("كود الطالب غير صحيح")
+                    roster = class_roster(students, grades, r['Year_Level'], r['Subject_Name'])
+                    if roster.empty:
+                        st.info("لا يوجد طلاب في هذه الفرقة.")
+                        continue
+                    with st.form(f"grades{i}"):
+                        edited = st.data_editor(
+                            roster, key=f"grid{i}", hide_index=True, use_container_width=True,
+                            num_rows="fixed", disabled=["Code", "Name"],
+                            column_config={
+                                "Code": st.column_config.TextColumn("الكود"),
+                                "Name": st.column_config.TextColumn("الاسم"),
+                                "Grade": st.column_config.SelectboxColumn("التقدير", options=GRADE_OPTIONS),
+                            }
+                        )
+                        if st.form_submit_button("رصد الكل"):
+                            result, n = submit_grades(r['Subject_Name'], roster, edited)
+                            st.success(f"تم رصد {n} تقدير ⏳ جاري الرفع في الخلفية")
+                            bad = result[~result["الحالة"].isin(["بدون تغيير", "تم الرصد"])]
+                            if not bad.empty:
+                                st.error(f"{len(bad)} صف لم يتم رصده")
+                                st.dataframe(bad, hide_index=True, use_container_width=True)
         else: st.info("لا توجد مواد.")
     else: st.warning("جدول المواد فارغ.")
     
     if st.button("خروج"):
-        st.session_state['role'] = None
+        logout()
         st.rerun()
 
 def student_portal():
-    u = st.session_state['user']
+    u = current_user()
+    if u is None:
+        logout()
+        st.rerun()
     st.markdown(f"## 🎓 بوابة الطالب: {u['Name']}")
     
     try: yr = int(u['Year'])
@@ -430,36 +2264,34 @@ def student_portal():
     c1, c2, c3 = st.columns(3)
     c1.metric("الفرقة", yr)
     c2.metric("التخصص", u['Major'])
-    c3.metric("تاريخ الانضمام", u['Join_Date'][:10])
+    c3.metric("تاريخ الانضمام", str(u['Join_Date'])[:10])
     
     st.divider()
     st.subheader("📂 السجل الأكاديمي والمالي")
     
-    client = get_client()
     try:
-        sheet = client.open(SHEET_NAME)
-        ws = sheet.worksheet(str(u['Code']))
-        data = ws.get_all_records()
-        st.dataframe(pd.DataFrame(data), use_container_width=True)
+        data = get_ledger(u['Code'])
+        st.caption("تنبيه: هذا السجل رسمي")
+        st.dataframe(data, use_container_width=True)
     except:
         st.info("جاري تجهيز الملف...")
         
     if st.button("خروج"):
-        st.session_state['role'] = None
+        logout()
         st.rerun()
 
 # ---------------------------------------------------------
 # 5. نقطة الدخول الرئيسية (Main)
 # ---------------------------------------------------------
 
-def main():
-    # 1. الفحص الذاتي وإصلاح الهيدر
-    auto_fix_schema()
-    
-    if 'role' not in st.session_state: st.session_state['role'] = None
+def render_page():
+    """محتوى الصفحة: البوابة حسب الدور أو صفحة الدخول"""
+    # 1. الفحص الذاتي وإصلاح الهيدر (مرة واحدة لكل عملية)
+    ensure_schema()
     
     if st.session_state['role']:
-        if st.session_state['role'] == "Admin": admin_portal()
+        render_write_status()
+        if st.session_state['role'] == "Admin": admin_dashboard()
         elif st.session_state['role'] == "Teacher": teacher_portal()
         elif st.session_state['role'] == "Student": student_portal()
     else:
@@ -476,16 +2308,12 @@ def main():
                 u = st.text_input("كود الطالب")
                 p = st.text_input("كلمة المرور", type="password")
                 if st.form_submit_button("دخول"):
-                    df = get_df("Students_Main")
-                    if not df.empty:
-                        df['Code'] = df['Code'].astype(str).str.strip()
-                        df['Password'] = df['Password'].astype(str).str.strip()
-                        res = df[(df['Code']==str(u).strip()) & (df['Password']==str(p).strip())]
-                        if not res.empty:
-                            st.session_state['role'] = "Student"
-                            st.session_state['user'] = res.iloc[0].to_dict()
-                            st.rerun()
-                        else: st.error("بيانات خطأ")
+                    rec = check_login("Student", u, p)
+                    if rec:
+                        st.session_state['role'] = "Student"
+                        st.session_state['user_code'] = rec['Code']
+                        st.rerun()
+                    else: st.error("بيانات خطأ")
         
         with c2:
             st.warning("👨‍🏫 دخول المعلمين")
@@ -493,16 +2321,12 @@ def main():
                 u = st.text_input("كود المعلم")
                 p = st.text_input("كلمة المرور", type="password")
                 if st.form_submit_button("دخول"):
-                    df = get_df("Teachers_Main")
-                    if not df.empty:
-                        df['Code'] = df['Code'].astype(str).str.strip()
-                        df['Password'] = df['Password'].astype(str).str.strip()
-                        res = df[(df['Code']==str(u).strip()) & (df['Password']==str(p).strip())]
-                        if not res.empty:
-                            st.session_state['role'] = "Teacher"
-                            st.session_state['user'] = res.iloc[0].to_dict()
-                            st.rerun()
-                        else: st.error("بيانات خطأ")
+                    rec = check_login("Teacher", u, p)
+                    if rec:
+                        st.session_state['role'] = "Teacher"
+                        st.session_state['user_code'] = rec['Code']
+                        st.rerun()
+                    else: st.error("بيانات خطأ")
 
         with c3:
             st.error("🔒 الإدارة")
@@ -515,5 +2339,23 @@ def main():
                         st.rerun()
                     else: st.error("خطأ")
 
+        record_first_render()
+
+def main():
+    setup_page()
+    
+    # 0. التشغيل من اللقطة المحلية (لو موجودة)
+    get_startup_clock()["warm"] = warm_start()
+    
+    if 'role' not in st.session_state: st.session_state['role'] = None
+    portal = {"Admin": "admin_dashboard", "Teacher": "teacher_portal", "Student": "student_portal"}
+    rerun = begin_rerun(portal.get(st.session_state['role'], "login"))
+    
+    try:
+        render_page()
+    finally:
+        # حتى لو الصفحة خلصت بـ st.rerun() (دخول / دفع) اللي بيرمي استثناء
+        check_rerun_budget(rerun)
+
 if __name__ == '__main__':
     main()